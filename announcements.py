@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+The "nearly sold out" announcement.
+
+Membership of the NearlySoldOut set is updated whenever a conference's
+seat count crosses ANNOUNCEMENT_SEATS_THRESHOLD, and the announcement is
+served from memcache. A stale entry keeps being served while a single
+rebuilder, elected with memcache.add, refreshes it from the set. The
+hourly cron only re-derives the set from a full query, as a
+consistency sweep.
+
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import NearlySoldOut
+
+ANNOUNCEMENT_SEATS_THRESHOLD = 5
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_ANNOUNCEMENTS_LOCK_KEY = "RECENT_ANNOUNCEMENTS_LOCK"
+# serve an entry without revalidating it for this long
+ANNOUNCEMENT_FRESH_SECONDS = 60
+ANNOUNCEMENT_LOCK_SECONDS = 10
+
+_SET_KEY = ndb.Key(NearlySoldOut, 'nearlySoldOut')
+
+
+def _formatAnnouncement(members):
+    if not members:
+        return ""
+    return '%s %s' % (
+        'Last chance to attend! The following conferences '
+        'are nearly sold out:',
+        ', '.join(sorted(members.values())))
+
+
+def _cacheMembers(members):
+    """Put a freshly built announcement into memcache & return its text."""
+    text = _formatAnnouncement(members)
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, {
+        'text': text,
+        'members': members,
+        'freshUntil': time.time() + ANNOUNCEMENT_FRESH_SECONDS,
+    })
+    return text
+
+
+def getAnnouncement():
+    """Return the current announcement, or an empty string."""
+    entry = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if entry is not None and entry['freshUntil'] > time.time():
+        return entry['text']
+    # only one request rebuilds; the others keep serving the stale copy
+    if memcache.add(MEMCACHE_ANNOUNCEMENTS_LOCK_KEY, 1,
+                    time=ANNOUNCEMENT_LOCK_SECONDS):
+        try:
+            nso = _SET_KEY.get()
+            return _cacheMembers(nso.conferences if nso else {})
+        finally:
+            memcache.delete(MEMCACHE_ANNOUNCEMENTS_LOCK_KEY)
+    return entry['text'] if entry else ""
+
+
+@ndb.transactional()
+def _updateMember(wsck, name):
+    nso = _SET_KEY.get() or NearlySoldOut(key=_SET_KEY)
+    if nso.conferences.get(wsck) == name:
+        return nso.conferences
+    members = dict(nso.conferences)
+    if name is None:
+        members.pop(wsck, None)
+    else:
+        members[wsck] = name
+    nso.conferences = members
+    nso.put()
+    return members
+
+
+def seatsChanged(conf, seats_available):
+    """Add a conference to or drop it from the set if its seat count has
+    crossed the threshold; cheap when membership is unchanged."""
+    wsck = conf.key.urlsafe()
+    name = None
+    if 0 < seats_available <= ANNOUNCEMENT_SEATS_THRESHOLD:
+        name = conf.name
+    entry = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if entry is not None and entry['members'].get(wsck) == name:
+        return
+    _cacheMembers(_updateMember(wsck, name))
+
+
+def sweep():
+    """Re-derive the whole set from the datastore; run by the cron as a
+    consistency check. Returns the announcement."""
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= ANNOUNCEMENT_SEATS_THRESHOLD,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+    members = dict((conf.key.urlsafe(), conf.name) for conf in confs)
+    NearlySoldOut(key=_SET_KEY, conferences=members).put()
+    return _cacheMembers(members)
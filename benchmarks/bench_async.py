@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""bench_async.py
+
+Latency of the endpoints whose datastore RPCs now overlap (getConference,
+registerForConference/unregisterFromConference, createSession), run on
+testbed stubs that add a simulated round trip to every datastore and
+memcache call. Run it on two checkouts to compare before and after:
+
+    GAE_SDK=/path/to/google_appengine python benchmarks/bench_async.py
+
+"""
+
+import datetime
+import optparse
+import time
+
+import sdk
+sdk.setup()
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def timeCalls(func, count):
+    """Run func count times, each as a fresh request; return millis."""
+    samples = []
+    for i in range(count):
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        start = time.time()
+        func(i)
+        samples.append((time.time() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--calls', type='int', default=50)
+    parser.add_option('-l', '--latency', type='float', default=20,
+                      help='simulated RPC round trip in milliseconds')
+    options, _ = parser.parse_args()
+
+    tb = sdk.startTestbed(latency=options.latency / 1000.0)
+    try:
+        from conference import ConferenceApi
+        from conference import CONF_GET_REQUEST
+        from conference import SESS_POST_REQUEST
+        from models import ConferenceForm
+
+        from models import Conference
+
+        api = ConferenceApi()
+        api._createConferenceObject(ConferenceForm(
+            name='Benchmark Conference', city='London', maxAttendees=1000,
+            startDate=str(datetime.date.today())))
+        conf_key = Conference.query(
+            Conference.name == 'Benchmark Conference').get(keys_only=True)
+        get_request = CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=conf_key.urlsafe())
+
+        def register(i):
+            if i % 2:
+                api.unregisterFromConference(get_request)
+            else:
+                api.registerForConference(get_request)
+
+        def createSession(i):
+            api.createSession(SESS_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=conf_key.urlsafe(),
+                name='Session %d' % i, duration=60))
+
+        cases = [
+            ('getConference', lambda i: api.getConference(get_request)),
+            ('(un)register', register),
+            ('createSession', createSession),
+        ]
+        print('simulated RPC latency: %gms' % options.latency)
+        print('%-16s %10s %10s %10s' % ('endpoint', 'mean', 'p50', 'p90'))
+        for name, func in cases:
+            samples = timeCalls(func, options.calls)
+            print('%-16s %8.1fms %8.1fms %8.1fms' % (name,
+                sum(samples) / len(samples), percentile(samples, 0.5),
+                percentile(samples, 0.9)))
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""bench_converters.py
+
+Micro-benchmark of entity to message copying: the per-entity
+all_fields()/hasattr/getattr/setattr loop the _copy*ToForm helpers used
+to run against the converters.py copy plans.
+
+    GAE_SDK=/path/to/google_appengine python benchmarks/bench_converters.py
+
+"""
+
+import datetime
+import optparse
+import timeit
+
+import sdk
+sdk.setup()
+
+from google.appengine.ext import ndb
+
+import converters
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import Session
+from models import SessionForm
+
+
+def reflectionCopy(entity, form_class, extra):
+    """The copy loop of the old _copyConferenceToForm/_copySessionToForm."""
+    form = form_class()
+    for field in form.all_fields():
+        if hasattr(entity, field.name):
+            if field.name.endswith('Date'):
+                setattr(form, field.name, str(getattr(entity, field.name)))
+            else:
+                setattr(form, field.name, getattr(entity, field.name))
+        elif field.name in extra:
+            setattr(form, field.name, extra[field.name])
+    form.check_initialized()
+    return form
+
+
+def makeEntities(count):
+    p_key = ndb.Key(Profile, 'organizer@example.com')
+    start = datetime.date(2016, 5, 1)
+    conferences = []
+    sessions = []
+    for i in range(count):
+        c_key = ndb.Key(Conference, i + 1, parent=p_key)
+        conferences.append(Conference(key=c_key,
+            name='Conference %d' % i, description='A conference',
+            organizerUserId=p_key.id(), topics=['Web', 'Programming'],
+            city='London', startDate=start, endDate=start, month=5,
+            maxAttendees=500, seatsAvailable=200))
+        sessions.append(Session(key=ndb.Key(Session, i + 1, parent=c_key),
+            name='Session %d' % i, highlights='Highlights',
+            speaker='Speaker %d' % (i % 50), typeOfSession='lecture',
+            location='Room 1', hasStartTime=True, duration=60,
+            startdatetime=datetime.datetime(2016, 5, 1, 9, 30),
+            conferenceName='Conference %d' % i))
+    return conferences, sessions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--entities', type='int', default=1000)
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    options, _ = parser.parse_args()
+
+    conferences, sessions = makeEntities(options.entities)
+    cases = [('Conference', conferences, ConferenceForm),
+             ('Session', sessions, SessionForm)]
+    print('%-12s %12s %12s %8s' % ('model', 'reflection', 'converter', 'speedup'))
+    for name, entities, form_class in cases:
+        converter = converters.Converter(type(entities[0]), form_class)
+        extra = lambda entity: {'websafeKey': entity.key.urlsafe()}
+        old = min(timeit.repeat(
+            lambda: [reflectionCopy(e, form_class, extra(e)) for e in entities],
+            number=1, repeat=options.repeat))
+        new = min(timeit.repeat(
+            lambda: converter.copyAll(entities, extra),
+            number=1, repeat=options.repeat))
+        print('%-12s %10.1fms %10.1fms %7.1fx' % (
+            name, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
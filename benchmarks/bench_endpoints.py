@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+"""bench_endpoints.py
+
+Runs every ConferenceApi endpoint on the testbed stubs against seeded
+data and reports, per call: wall time, datastore RPCs, entities read and
+written, memcache hits and caller identity lookups. Results can be saved
+as a baseline and later runs compared against it; the script exits with
+status 1 if any endpoint regressed or looked up the caller more than
+once in a call.
+
+    GAE_SDK=/path/to/google_appengine python benchmarks/bench_endpoints.py \
+        --conferences 20 --sessions 10 --profiles 50 --save-baseline
+    GAE_SDK=/path/to/google_appengine python benchmarks/bench_endpoints.py
+
+No baseline is committed; save one from the commit you compare against.
+
+"""
+
+import datetime
+import json
+import optparse
+import os
+import random
+import time
+
+import sdk
+sdk.setup()
+
+from rpcstats import COUNTERS
+from rpcstats import RpcStats
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baseline.json')
+ORGANIZER = 'organizer@example.com'
+CITIES = ('London', 'Paris', 'Tokyo', 'Chicago')
+TOPICS = ('Web Technologies', 'Programming Languages', 'Medical Innovations')
+SESSION_TYPES = ('Lecture', 'Keynote', 'Workshop', 'Seminar')
+
+
+def userEmail(i):
+    return 'user%d@example.com' % i
+
+
+def seed(api, options, rand):
+    """Create the conferences, sessions & profiles; return the keys the
+    endpoint cases need."""
+    from conference import CONF_GET_REQUEST
+    from conference import SESS_BULK_POST_REQUEST
+    from conference import SESS_WISH
+    from models import Conference
+    from models import ConferenceForm
+    from models import Profile
+    from models import Session
+    from models import SessionForm
+    from google.appengine.ext import ndb
+
+    start = datetime.date.today() + datetime.timedelta(days=30)
+    for i in range(options.conferences):
+        sdk.newRequest(ORGANIZER)
+        api.createConference(ConferenceForm(name='Conference %d' % i,
+            city=CITIES[i % len(CITIES)],
+            topics=[TOPICS[i % len(TOPICS)], TOPICS[(i + 1) % len(TOPICS)]],
+            maxAttendees=options.profiles * 2,
+            startDate=str(start + datetime.timedelta(days=i * 7)),
+            endDate=str(start + datetime.timedelta(days=i * 7 + 2))))
+    conf_keys = Conference.query(
+        ancestor=ndb.Key(Profile, ORGANIZER)).fetch(keys_only=True)
+
+    for conf_key in conf_keys:
+        sdk.newRequest(ORGANIZER)
+        api.createSessions(SESS_BULK_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=conf_key.urlsafe(),
+            items=[SessionForm(name='Session %d' % j,
+                               speaker='Speaker %d' % (j % 10),
+                               typeOfSession=SESSION_TYPES[j % len(SESSION_TYPES)],
+                               startDate=str(start), startTime='%02d:00' % (9 + j % 10),
+                               duration=60, highlights='Highlights ' * 20)
+                   for j in range(options.sessions)]))
+    session_keys = Session.query().fetch(keys_only=True)
+
+    for i in range(options.profiles):
+        sdk.newRequest(userEmail(i))
+        api.registerForConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=rand.choice(conf_keys).urlsafe()))
+        for s_key in rand.sample(session_keys, min(options.wishlist, len(session_keys))):
+            api.addSessionToWishlist(SESS_WISH.combined_message_class(
+                websafeSessionKey=s_key.urlsafe()))
+    return conf_keys, session_keys
+
+
+def endpointCases(api, conf_keys, session_keys):
+    """Return (name, email of caller, callable taking the iteration) for
+    every endpoint, plus a setup callable run before the measured call
+    where the call needs fresh data of its own."""
+    from conference import CONF_GET_REQUEST
+    from conference import CONF_PAGE_REQUEST
+    from conference import CONF_POST_REQUEST
+    from conference import SESS_BULK_POST_REQUEST
+    from conference import SESS_CONF_GET_REQUEST
+    from conference import SESS_CONF_SPKR_GET_REQUEST
+    from conference import SESS_CONF_TYPE_GET_REQUEST
+    from conference import SESS_POST_REQUEST
+    from conference import SESS_SPKR_GET_REQUEST
+    from conference import SESS_TIME_GET_REQUEST
+    from conference import SESS_TYPE_GET_REQUEST
+    from conference import SESS_WISH
+    from models import ConferenceForm
+    from models import ConferenceQueryForm
+    from models import ConferenceQueryForms
+    from models import ProfileMiniForm
+    from models import SessionForm
+    from models import SessionQueryForm
+    from models import SessionQueryForms
+    from protorpc import message_types
+
+    void = message_types.VoidMessage()
+    wsck = conf_keys[0].urlsafe()
+    wssk = session_keys[0].urlsafe()
+    conf = CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=wsck)
+    page = CONF_PAGE_REQUEST.combined_message_class()
+    wish = SESS_WISH.combined_message_class(websafeSessionKey=wssk)
+
+    def query(*filters):
+        return ConferenceQueryForms(filters=[
+            ConferenceQueryForm(field=field, operator=op, value=value)
+            for field, op, value in filters])
+
+    def organizer(name, method, request):
+        return (name, ORGANIZER, lambda i: method(request))
+
+    def user(name, method, request):
+        return (name, 'bench@example.com', lambda i: method(request))
+
+    # each deleteConference call gets a conference of its own
+    doomed = {}
+
+    def createDoomed(i):
+        doomed[i] = api.createConference(ConferenceForm(
+            name='Doomed Conference %d' % i, city='Paris', maxAttendees=100))
+
+    def deleteDoomed(i):
+        form = doomed.pop(i)
+        return api.deleteConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=form.websafeKey))
+
+    return [
+        user('getProfile', api.getProfile, void),
+        ('saveProfile', 'bench@example.com', lambda i: api.saveProfile(
+            ProfileMiniForm(displayName='Bench %d' % i))),
+        ('createConference', ORGANIZER, lambda i: api.createConference(
+            ConferenceForm(name='Benchmark Conference %d' % i, city='London',
+                           maxAttendees=100))),
+        ('deleteConference', ORGANIZER, deleteDoomed, createDoomed),
+        ('updateConference', ORGANIZER, lambda i: api.updateConference(
+            CONF_POST_REQUEST.combined_message_class(websafeConferenceKey=wsck,
+                description='Updated %d' % i))),
+        user('getConference', api.getConference, conf),
+        user('queryConferences(all)', api.queryConferences, query()),
+        user('queryConferences(city)', api.queryConferences,
+             query(('CITY', 'EQ', 'London'))),
+        user('queryConferences(city,topic,month)', api.queryConferences,
+             query(('CITY', 'EQ', 'London'), ('TOPIC', 'EQ', TOPICS[0]),
+                   ('MONTH', 'GT', '0'))),
+        user('queryConferences(maxAttendees)', api.queryConferences,
+             query(('MAX_ATTENDEES', 'GT', '10'))),
+        organizer('getConferencesCreated', api.getConferencesCreated, page),
+        user('filterPlayground', api.filterPlayground, page),
+        user('getConferenceSessions', api.getConferenceSessions,
+             SessionQueryForms(filters=[SessionQueryForm(
+                 field='websafeConferenceKey', operator='EQ', value=wsck)])),
+        user('getSessionsByType', api.getSessionsByType,
+             SESS_TYPE_GET_REQUEST.combined_message_class(type='Workshop')),
+        user('getConferenceSessionsByType', api.getConferenceSessionsByType,
+             SESS_CONF_TYPE_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=wsck, type='Workshop')),
+        user('getSessionsBySpeaker', api.getSessionsBySpeaker,
+             SESS_SPKR_GET_REQUEST.combined_message_class(speaker='Speaker 1')),
+        user('getConferenceSessionsBySpeaker', api.getConferenceSessionsBySpeaker,
+             SESS_CONF_SPKR_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=wsck, speaker='Speaker 1')),
+        user('getSessionsByTime', api.getSessionsByTime,
+             SESS_TIME_GET_REQUEST.combined_message_class(
+                 startsBefore=12, excludeTypes=['workshop'])),
+        ('createSession', ORGANIZER, lambda i: api.createSession(
+            SESS_POST_REQUEST.combined_message_class(websafeConferenceKey=wsck,
+                name='Benchmark Session %d' % i, speaker='Speaker 1'))),
+        ('createSessions', ORGANIZER, lambda i: api.createSessions(
+            SESS_BULK_POST_REQUEST.combined_message_class(websafeConferenceKey=wsck,
+                items=[SessionForm(name='Bulk Session %d-%d' % (i, j))
+                       for j in range(20)]))),
+        ('registerForConference', None, lambda i: api.registerForConference(conf)),
+        ('unregisterFromConference', None, lambda i: api.unregisterFromConference(conf)),
+        user('getConferencesToAttend', api.getConferencesToAttend, page),
+        user('isUserWishing', api.isUserWishing, wish),
+        user('addSessionToWishlist', api.addSessionToWishlist, wish),
+        user('getSessionsInWishlist', api.getSessionsInWishlist,
+             SESS_CONF_GET_REQUEST.combined_message_class()),
+        user('removeSessionFromWishlist', api.removeSessionFromWishlist, wish),
+        user('getAnnouncement', api.getAnnouncement, void),
+        user('getFeaturedSpeaker', api.getFeaturedSpeaker, void),
+    ]
+
+
+def run(cases, stats, repeat):
+    """Call each case repeat times; return {name: per call medians},
+    with the most identity lookups any one call made."""
+    import endpoints
+    import instrumentation
+
+    results = {}
+    for case in cases:
+        name, email, func, setup = (case + (None,))[:4]
+        samples = []
+        errors = 0
+        for i in range(repeat):
+            if setup:
+                sdk.newRequest(email)
+                setup(i)
+            # (un)registration runs once per user, each a fresh caller
+            sdk.newRequest(email or 'bench-register-%d@example.com' % i)
+            stats.reset()
+            started = time.time()
+            try:
+                func(i)
+            except endpoints.ServiceException:
+                errors += 1
+            sample = stats.snapshot()
+            sample['wallMs'] = (time.time() - started) * 1000
+            sample['identityLookups'] = \
+                instrumentation.lastRequest().identityLookups
+            samples.append(sample)
+        result = dict((counter, sorted(s[counter] for s in samples)[len(samples) // 2])
+                      for counter in ('wallMs',) + COUNTERS)
+        result['errors'] = errors
+        result['identityLookups'] = max(s['identityLookups'] for s in samples)
+        results[name] = result
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against a baseline: more RPCs or
+    entities than before, or wall time over the tolerance."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        for counter in ('datastoreRpcs', 'entitiesRead', 'entitiesWritten',
+                        'memcacheRpcs'):
+            if result[counter] > before.get(counter, 0):
+                regressions.append('%s: %s %d -> %d' % (
+                    name, counter, before.get(counter, 0), result[counter]))
+        if result['wallMs'] > before['wallMs'] * (1 + tolerance):
+            regressions.append('%s: wallMs %.1f -> %.1f' % (
+                name, before['wallMs'], result['wallMs']))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--conferences', type='int', default=20)
+    parser.add_option('--sessions', type='int', default=10,
+                      help='sessions per conference')
+    parser.add_option('--profiles', type='int', default=50)
+    parser.add_option('--wishlist', type='int', default=5,
+                      help='wishlisted sessions per profile')
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--baseline', default=DEFAULT_BASELINE)
+    parser.add_option('--save-baseline', action='store_true')
+    parser.add_option('--tolerance', type='float', default=0.5,
+                      help='allowed relative wall time increase')
+    options, _ = parser.parse_args()
+    config = dict(conferences=options.conferences, sessions=options.sessions,
+                  profiles=options.profiles, wishlist=options.wishlist,
+                  repeat=options.repeat, seed=options.seed)
+
+    tb = sdk.startTestbed()
+    try:
+        from conference import ConferenceApi
+        api = ConferenceApi()
+        conf_keys, session_keys = seed(api, options, random.Random(options.seed))
+        stats = RpcStats()
+        stats.install()
+        results = run(endpointCases(api, conf_keys, session_keys), stats,
+                      options.repeat)
+    finally:
+        tb.deactivate()
+
+    print('%-36s %9s %6s %6s %6s %6s %6s %4s %4s' % ('endpoint', 'wall',
+        'dsRPC', 'read', 'write', 'mcRPC', 'mcHit', 'ids', 'err'))
+    for name, result in sorted(results.items()):
+        print('%-36s %7.1fms %6d %6d %6d %6d %6d %4d %4d' % (name,
+            result['wallMs'], result['datastoreRpcs'], result['entitiesRead'],
+            result['entitiesWritten'], result['memcacheRpcs'],
+            result['memcacheHits'], result['identityLookups'],
+            result['errors']))
+
+    # the caller is resolved once per request, however many helpers ask
+    repeated = [name for name, result in sorted(results.items())
+                if result['identityLookups'] > 1]
+    for name in repeated:
+        print('FAILED %s: %d identity lookups in one call'
+              % (name, results[name]['identityLookups']))
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f,
+                      indent=2, sort_keys=True)
+        print('\nbaseline saved to %s' % options.baseline)
+        return 1 if repeated else 0
+    if not os.path.exists(options.baseline):
+        print('\nno baseline at %s; run with --save-baseline to create one'
+              % options.baseline)
+        return 1 if repeated else 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('config') != config:
+        print('\nwarning: baseline was recorded with %s' % baseline.get('config'))
+    regressions = compare(results, baseline['results'], options.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions or repeated else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""bench_registration.py
+
+Ticket drop simulator: many concurrent registerForConference &
+unregisterFromConference calls go through _conferenceRegistration
+against the local datastore stub. Each worker thread gets its own request
+environment and ndb context, as it would on a multithreaded instance.
+
+The workload is generated up front from --seed, so a scenario can be
+re-run to compare registration strategies; --shards takes a list of seat
+shard counts and runs the same workload once for each.
+
+    GAE_SDK=/path/to/google_appengine python benchmarks/bench_registration.py \
+        --users 2000 --seats 500 --threads 50 --churn 0.1 --shards 1,5,20
+
+For every run it reports committed registrations per second, transaction
+commits that collided (and were retried by ndb), calls that failed, call
+latency percentiles, and checks the final seat count: registrations never
+exceed the seats (no oversell) and registrations plus free seats add up
+to maxAttendees (no lost seats). Exits with status 1 if a check fails.
+
+"""
+
+import Queue
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+import sdk
+sdk.setup()
+
+from google.appengine.ext import ndb
+
+
+class ContentionStats(object):
+    """Counts transactions & commit collisions through apiproxy hooks;
+    the hooks run on every worker thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'contention', self._postCall, 'datastore_v3')
+
+    def reset(self):
+        self.transactions = self.commits = self.collisions = 0
+
+    def _postCall(self, service, call, request, response, rpc=None, error=None):
+        # six arguments: the hook is also called for failed RPCs
+        if call not in ('BeginTransaction', 'Commit'):
+            return
+        with self.lock:
+            if call == 'BeginTransaction':
+                self.transactions += 1
+            elif error is None:
+                self.commits += 1
+            else:
+                self.collisions += 1
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def workload(options, run):
+    """Return the (email, register) calls of one run: every user registers
+    once and, with probability churn, unregisters again later."""
+    rand = random.Random(options.seed)
+    calls = []
+    for i in range(options.users):
+        email = 'run%d-user%d@example.com' % (run, i)
+        at = rand.random()
+        calls.append((at, email, True))
+        if rand.random() < options.churn:
+            calls.append((at + rand.random() * (1 - at), email, False))
+    return [(email, reg) for at, email, reg in sorted(calls)]
+
+
+def newConference(name, seats_count, num_shards):
+    """Create a conference whose seats are split over num_shards shards."""
+    import seats
+    from models import Conference
+
+    c_key = ndb.Key(Conference, Conference.allocate_ids(size=1)[0])
+    shards = seats.newShards(c_key, seats_count, num_shards)
+    ndb.put_multi([Conference(key=c_key, name=name, city='London',
+                              maxAttendees=seats_count,
+                              seatsAvailable=seats_count,
+                              organizerUserId='organizer',
+                              seatShards=len(shards))] + shards)
+    return c_key
+
+
+def runCalls(calls, conf_key, threads, environ):
+    """Run calls on a pool of threads; return (outcomes, latencies, secs)."""
+    from google.appengine.api import datastore_errors
+    from google.appengine.runtime import request_environment
+    from conference import CONF_GET_REQUEST
+    from conference import ConferenceApi
+    import endpoints
+
+    request = CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=conf_key.urlsafe())
+    pending = Queue.Queue()
+    for call in calls:
+        pending.put(call)
+    lock = threading.Lock()
+    outcomes = dict(registered=0, unregistered=0, soldOut=0, conflicts=0,
+                    failed=0)
+    latencies = []
+
+    def worker():
+        request_environment.current_request.Init(sys.stderr, dict(environ))
+        while True:
+            try:
+                email, reg = pending.get_nowait()
+            except Queue.Empty:
+                return
+            sdk.newRequest(email)
+            started = time.time()
+            try:
+                # a new instance per call, as endpoints does per request
+                ok = ConferenceApi()._conferenceRegistration(request, reg).data
+                outcome = ('registered' if reg else 'unregistered') if ok \
+                    else 'conflicts'
+            except endpoints.ServiceException as e:
+                outcome = 'soldOut' if 'no seats' in str(e) else 'conflicts'
+            except datastore_errors.TransactionFailedError:
+                # ndb gave up retrying the transaction
+                outcome = 'failed'
+            elapsed = (time.time() - started) * 1000
+            with lock:
+                outcomes[outcome] += 1
+                latencies.append(elapsed)
+
+    started = time.time()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return outcomes, latencies, time.time() - started
+
+
+def checkSeats(conf_key, seats_count):
+    """Return (registrations, free seats, problems) for a conference."""
+    import seats
+    from models import Registration
+
+    registrations = Registration.query(
+        Registration.conference == conf_key).count(limit=None)
+    conf = seats.syncSeatsAvailable(conf_key)
+    shards = ndb.get_multi(seats.shardKeys(conf_key, conf.seatShards))
+    free = sum(shard.seats for shard in shards if shard)
+    problems = []
+    if registrations > seats_count or [s for s in shards if s and s.seats < 0]:
+        problems.append('oversold: %d registrations for %d seats'
+                        % (registrations, seats_count))
+    if registrations + free != seats_count:
+        problems.append('lost seats: %d registrations + %d free != %d'
+                        % (registrations, free, seats_count))
+    if conf.seatsAvailable != free:
+        problems.append('seatsAvailable %d != %d free in shards'
+                        % (conf.seatsAvailable, free))
+    return registrations, free, problems
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-u', '--users', type='int', default=2000)
+    parser.add_option('-s', '--seats', type='int', default=500)
+    parser.add_option('-t', '--threads', type='int', default=50)
+    parser.add_option('--churn', type='float', default=0.1,
+                      help='share of users who unregister again')
+    parser.add_option('--shards', default='1,5,20',
+                      help='comma separated seat shard counts to compare')
+    parser.add_option('-l', '--latency', type='float', default=5,
+                      help='simulated RPC round trip in milliseconds')
+    parser.add_option('--seed', type='int', default=1)
+    options, _ = parser.parse_args()
+
+    tb = sdk.startTestbed(latency=options.latency / 1000.0)
+    failed = False
+    try:
+        from google.appengine.runtime import request_environment
+        # give each thread its own os.environ, as the runtime does
+        environ = dict(os.environ)
+        saved_environ = os.environ
+        request_environment.PatchOsEnviron()
+        request_environment.current_request.Init(sys.stderr, dict(environ))
+        stats = ContentionStats()
+        stats.install()
+
+        print('%-7s %7s %8s %6s %7s %7s %6s %6s %7s %7s %7s %7s' % ('shards',
+            'calls', 'commit/s', 'txns', 'collide', 'failed', 'sold', 'regs',
+            'free', 'p50ms', 'p99ms', 'maxms'))
+        for run, num_shards in enumerate(
+                int(n) for n in options.shards.split(',')):
+            conf_key = newConference('Ticket Drop %d' % run, options.seats,
+                                     num_shards)
+            calls = workload(options, run)
+            stats.reset()
+            outcomes, latencies, secs = runCalls(calls, conf_key,
+                                                 options.threads, environ)
+            registrations, free, problems = checkSeats(conf_key, options.seats)
+            print('%-7d %7d %8.1f %6d %7d %7d %6d %6d %7d %7.1f %7.1f %7.1f' % (
+                num_shards, len(calls),
+                (outcomes['registered'] + outcomes['unregistered']) / secs,
+                stats.transactions, stats.collisions, outcomes['failed'],
+                outcomes['soldOut'], registrations, free,
+                percentile(latencies, 0.5), percentile(latencies, 0.99),
+                max(latencies)))
+            for problem in problems:
+                print('  FAILED %s' % problem)
+            failed = failed or bool(problems)
+        os.environ = saved_environ
+    finally:
+        tb.deactivate()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
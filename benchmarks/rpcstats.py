@@ -0,0 +1,51 @@
+"""rpcstats.py
+
+Counts the API calls made while a benchmark runs, through an apiproxy
+post-call hook: datastore RPCs and the entities they read and write, and
+memcache lookups and hits.
+
+"""
+
+from collections import defaultdict
+
+COUNTERS = ('datastoreRpcs', 'entitiesRead', 'entitiesWritten',
+            'memcacheRpcs', 'memcacheHits', 'memcacheMisses')
+
+
+class RpcStats(object):
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def install(self):
+        """Start counting; call after the testbed is activated, which
+        replaces the apiproxy."""
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpcstats', self._postCall)
+
+    def reset(self):
+        self.counts = defaultdict(int)
+
+    def snapshot(self):
+        return dict((name, self.counts[name]) for name in COUNTERS)
+
+    def _postCall(self, service, call, request, response):
+        counts = self.counts
+        counts['%s.%s' % (service, call)] += 1
+        if service == 'datastore_v3':
+            counts['datastoreRpcs'] += 1
+            if call == 'Get':
+                counts['entitiesRead'] += sum(
+                    1 for result in response.entity_list() if result.has_entity())
+            elif call in ('RunQuery', 'Next'):
+                counts['entitiesRead'] += response.result_size()
+            elif call == 'Put':
+                counts['entitiesWritten'] += request.entity_size()
+            elif call == 'Delete':
+                counts['entitiesWritten'] += request.key_size()
+        elif service == 'memcache':
+            counts['memcacheRpcs'] += 1
+            if call == 'Get':
+                counts['memcacheHits'] += response.item_size()
+                counts['memcacheMisses'] += request.key_size() - response.item_size()
@@ -0,0 +1,88 @@
+"""sdk.py
+
+Puts the App Engine SDK and the app on sys.path for the benchmark
+scripts. The SDK is looked for in $GAE_SDK, then next to dev_appserver.py
+on $PATH.
+
+"""
+
+import os
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _findSdk():
+    if os.environ.get('GAE_SDK'):
+        return os.environ['GAE_SDK']
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path, 'dev_appserver.py')):
+            return os.path.realpath(path)
+    sys.exit('App Engine SDK not found; set GAE_SDK to its directory.')
+
+
+def setup():
+    """Make the SDK, its bundled libraries and the app importable."""
+    sdk = _findSdk()
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('APPLICATION_ID', 'dev~conference-benchmark')
+
+
+class _LatencyRPC(object):
+    """Mixin for an SDK stub's RPC class: every call completes latency
+    seconds after it was made, whether or not other calls are waited on
+    first, the way concurrent RPCs to the real services overlap."""
+
+    latency = 0
+
+    def _MakeCallImpl(self):
+        self._readyAt = time.time() + self.latency
+        super(_LatencyRPC, self)._MakeCallImpl()
+
+    def _WaitImpl(self):
+        time.sleep(max(0, self._readyAt - time.time()))
+        return super(_LatencyRPC, self)._WaitImpl()
+
+
+def startTestbed(latency=0, services=('datastore_v3', 'memcache')):
+    """Activate a testbed with the stubs the app needs; calls to the named
+    services are given latency seconds of simulated round trip time."""
+    from google.appengine.api import apiproxy_rpc
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(ENDPOINTS_AUTH_EMAIL='benchmark@example.com',
+                 ENDPOINTS_AUTH_DOMAIN='example.com',
+                 overwrite=True)
+    tb.init_datastore_v3_stub(consistency_policy=
+        datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    tb.init_memcache_stub()
+    tb.init_user_stub()
+    tb.init_taskqueue_stub(root_path=ROOT)
+    tb.init_mail_stub()
+    tb.init_urlfetch_stub()
+
+    if latency:
+        rpc_class = type('LatencyRPC', (_LatencyRPC, apiproxy_rpc.RPC),
+                         {'latency': latency})
+        for service in services:
+            stub = apiproxy_stub_map.apiproxy.GetStub(service)
+            stub.CreateRPC = lambda stub=stub: rpc_class(stub=stub)
+    return tb
+
+
+def newRequest(email='benchmark@example.com'):
+    """Make the next API call look like a fresh request signed in as
+    email: a new request ID and an empty ndb in-context cache."""
+    from google.appengine.ext import ndb
+    os.environ['REQUEST_LOG_ID'] = uuid.uuid4().hex
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    ndb.get_context().clear_cache()
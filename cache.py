@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Caching helpers for the conference API: the getConference read-through
+cache, the queryConferences result cache and the counters behind them,
+plus a small process-local LRU.
+
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from protorpc import protojson
+
+from models import ConferenceForm
+from models import ConferenceForms
+
+MEMCACHE_CONFERENCE_KEY = "CONFERENCE_FORM:%s"
+MEMCACHE_COUNTER_KEY = "CACHE_COUNTER:%s"
+CONFERENCE_CACHE_TIMEOUT = 600
+# after an invalidation, refuse re-population for this long so a reader
+# holding pre-update data cannot put it back
+INVALIDATION_LOCK_SECONDS = 2
+
+CONFERENCE_COUNTERS = ('conference.hit', 'conference.miss',
+                       'conference.invalidation')
+
+MEMCACHE_QUERY_GENERATION_KEY = "CONFERENCE_QUERY_GENERATION"
+MEMCACHE_QUERY_KEY = "CONFERENCE_QUERY:%d:%s"
+MEMCACHE_QUERY_SHAPES_KEY = "CONFERENCE_QUERY_SHAPES"
+QUERY_CACHE_TIMEOUT = 300
+
+
+class LRUCache(object):
+    """Thread-safe, process-local LRU cache whose entries optionally
+    expire after ttl seconds."""
+
+    def __init__(self, capacity, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return default
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# organizer Profile key -> displayName; the TTL bounds how long another
+# instance can show a name after the organizer changed it
+organizerNames = LRUCache(1000, ttl=60)
+
+
+def incrCounter(name, delta=1):
+    """Increment a named cache counter."""
+    memcache.incr(MEMCACHE_COUNTER_KEY % name, delta, initial_value=0)
+
+
+def getCounters(names):
+    """Return a dict of the current values of the named counters."""
+    values = memcache.get_multi([MEMCACHE_COUNTER_KEY % name for name in names])
+    return dict((name, values.get(MEMCACHE_COUNTER_KEY % name, 0))
+                for name in names)
+
+
+def getConferenceForm(wsck):
+    """Return the cached ConferenceForm for a websafe key, or None."""
+    data = memcache.get(MEMCACHE_CONFERENCE_KEY % wsck)
+    if data is None:
+        incrCounter('conference.miss')
+        return None
+    incrCounter('conference.hit')
+    return protojson.decode_message(ConferenceForm, data)
+
+
+def setConferenceForm(wsck, cf):
+    """Cache a ConferenceForm unless the entry was just invalidated."""
+    memcache.add(MEMCACHE_CONFERENCE_KEY % wsck,
+        protojson.encode_message(cf), time=CONFERENCE_CACHE_TIMEOUT)
+
+
+def invalidateConferenceForm(wsck):
+    """Drop the cached ConferenceForm for a websafe key."""
+    memcache.delete(MEMCACHE_CONFERENCE_KEY % wsck,
+        seconds=INVALIDATION_LOCK_SECONDS)
+    incrCounter('conference.invalidation')
+
+
+def _newGeneration():
+    # start from the clock so a generation counter lost to eviction never
+    # comes back with a number that older cached results still carry
+    return int(time.time() * 1000)
+
+
+def conferenceGeneration():
+    """Return the current Conference data generation."""
+    generation = memcache.get(MEMCACHE_QUERY_GENERATION_KEY)
+    if generation is None:
+        memcache.add(MEMCACHE_QUERY_GENERATION_KEY, _newGeneration())
+        generation = memcache.get(MEMCACHE_QUERY_GENERATION_KEY)
+    return generation or 0
+
+
+def bumpConferenceGeneration():
+    """Invalidate every cached query result; call after any Conference
+    write."""
+    memcache.incr(MEMCACHE_QUERY_GENERATION_KEY,
+        initial_value=_newGeneration())
+
+
+def conferenceQueryKey(filters, page_size, page_token, fields=None):
+    """Return (shape, cache key) for a list of formatted filters and an
+    optional field mask.
+
+    The key is built from the sorted (field, operator, value) triples and
+    the sorted mask, so the order either was given in doesn't matter; the
+    shape leaves out the values and names the kind of query for the
+    statistics.
+    """
+    triples = sorted((f["field"], f["operator"], f["value"]) for f in filters)
+    shape = '&'.join(sorted(set('%s%s' % (field, op)
+                                for field, op, value in triples))) or 'all'
+    canonical = json.dumps([triples, page_size, page_token,
+                            sorted(fields or ())])
+    return shape, hashlib.sha1(canonical).hexdigest()
+
+
+def getConferenceQuery(shape, key):
+    """Return cached ConferenceForms for a query, or None."""
+    data = memcache.get(MEMCACHE_QUERY_KEY % (conferenceGeneration(), key))
+    if data is None:
+        incrCounter('query.%s.miss' % shape)
+        return None
+    incrCounter('query.%s.hit' % shape)
+    return protojson.decode_message(ConferenceForms, data)
+
+
+def setConferenceQuery(shape, key, forms, elapsed):
+    """Cache the ConferenceForms of a query that took elapsed seconds."""
+    memcache.set(MEMCACHE_QUERY_KEY % (conferenceGeneration(), key),
+        protojson.encode_message(forms), time=QUERY_CACHE_TIMEOUT)
+    incrCounter('query.%s.missMillis' % shape, int(elapsed * 1000))
+    _rememberShape(shape)
+
+
+def _rememberShape(shape):
+    client = memcache.Client()
+    for i in range(3):
+        shapes = client.gets(MEMCACHE_QUERY_SHAPES_KEY)
+        if shapes is None:
+            if client.add(MEMCACHE_QUERY_SHAPES_KEY, [shape]):
+                return
+            continue
+        if shape in shapes or client.cas(MEMCACHE_QUERY_SHAPES_KEY,
+                                         shapes + [shape]):
+            return
+
+
+def getQueryStats():
+    """Return hits, misses, hit ratio and estimated time saved per query
+    shape; the saving assumes each hit would have cost an average miss."""
+    stats = {}
+    for shape in memcache.get(MEMCACHE_QUERY_SHAPES_KEY) or []:
+        counters = getCounters(['query.%s.%s' % (shape, name)
+                                for name in ('hit', 'miss', 'missMillis')])
+        hits = counters['query.%s.hit' % shape]
+        misses = counters['query.%s.miss' % shape]
+        avg_miss = counters['query.%s.missMillis' % shape] / float(misses or 1)
+        stats[shape] = {
+            'hits': hits,
+            'misses': misses,
+            'hitRatio': hits / float(hits + misses or 1),
+            'avgMissMillis': avg_miss,
+            'savedMillis': int(hits * avg_miss),
+        }
+    return stats
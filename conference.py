@@ -15,17 +15,23 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 from google.appengine.api import memcache
 
 from datetime import datetime
+import logging
+import os
+import time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from models import Profile
+from models import Registration
+from models import WishlistEntry
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import TeeShirtSize
@@ -41,17 +47,37 @@ from models import ConflictException
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionCreateResult
+from models import SessionCreateResults
 from models import SessionQueryForm
 from models import SessionQueryForms
+from models import SESSION_TYPES
 
 from utils import getUserId
 import json
+import announcements
+import cache
+import converters
+import deletion
+import instrumentation
+import names
+import planner
+import seats
+import speakers
 
 from settings import WEB_CLIENT_ID
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# bounds the work of one page when the planner leaves filters in memory
+MAX_SCANNED_PER_PAGE = 2000
+MAX_BULK_SESSIONS = 500
+SESSION_PUT_BATCH_SIZE = 100
+
+log = logging.getLogger(__name__)
+log.addFilter(instrumentation.RateLimitFilter())
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -83,12 +109,26 @@ SESSION_FIELDS =    {
             'TYPE': 'typeOfSession',
             }
 
+# copy plans for the _copy*ToForm helpers, worked out once at import
+CONFERENCE_CONVERTER = converters.register(Conference, ConferenceForm)
+SESSION_CONVERTER = converters.register(Session, SessionForm)
+PROFILE_CONVERTER = converters.register(Profile, ProfileForm,
+    convert={'teeShirtSize': lambda size: getattr(TeeShirtSize, size)},
+    exclude=('conferenceKeysToAttend', 'sessionKeysWishList'))
+
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -103,28 +143,53 @@ SESS_QUERY_REQUEST = endpoints.ResourceContainer(
 SESS_SPKR_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
 )
 
 SESS_CONF_SPKR_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     speaker=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+    fields=messages.StringField(5, repeated=True),
 )
 
 SESS_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     type=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
 )
 
 SESS_CONF_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     type=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+    fields=messages.StringField(5, repeated=True),
+)
+
+SESS_TIME_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    startsBefore=messages.IntegerField(1),
+    excludeTypes=messages.StringField(2, repeated=True),
+    websafeConferenceKey=messages.StringField(3),
+    pageSize=messages.IntegerField(4),
+    pageToken=messages.StringField(5),
+    fields=messages.StringField(6, repeated=True),
 )
 
 SESS_CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
 )
 
 SESS_WISH = endpoints.ResourceContainer(
@@ -136,6 +201,12 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
     SessionForm,
     websafeConferenceKey=messages.StringField(1),
 )
+
+SESS_BULK_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 class SESS_CONF_RESPONSE(messages.Message):
     email = messages.MessageField(SessionForm, 1)
 
@@ -145,6 +216,50 @@ class Object:
         return json.dumps(self, default=lambda o: o.__dict__, 
             sort_keys=True, indent=4)
 
+
+class RequestContext(object):
+    """RequestContext -- the caller's user, user ID & Profile, resolved at
+    most once per request and shared by every ConferenceApi helper, plus
+    the entities changed by the request but not yet written"""
+
+    def __init__(self, requestId=None):
+        self.requestId = requestId
+        self.user = None
+        self.userId = None
+        self.profile = None
+        self._resolved = False
+        self._dirty = {}
+
+    def markDirty(self, entity):
+        """Remember that entity needs writing before the request ends."""
+        self._dirty[entity.key] = entity
+
+    def takeDirty(self):
+        """Return the entities waiting to be written, for the caller to
+        put along with its own writes; they are no longer tracked."""
+        entities = self._dirty.values()
+        self._dirty = {}
+        return entities
+
+    def flush(self):
+        """Write whatever is still waiting, in one put_multi."""
+        entities = self.takeDirty()
+        if entities:
+            ndb.put_multi(entities)
+
+    def resolveUser(self):
+        """Return (user, user_id), looking them up on first use only."""
+        if not self._resolved:
+            self._resolved = True
+            instrumentation.countIdentityLookup()
+            with instrumentation.phase('auth'):
+                self.user = endpoints.get_current_user()
+                if self.user:
+                    self.userId = getUserId(self.user)
+        if not self.user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self.user, self.userId
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -159,27 +274,38 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        # registrations & wishlist live in child entities keyed by websafe key
+        reg_keys = Registration.query(ancestor=prof.key).fetch_async(keys_only=True)
+        wish_keys = WishlistEntry.query(ancestor=prof.key).fetch_async(keys_only=True)
+        return PROFILE_CONVERTER.copy(prof,
+            conferenceKeysToAttend=[key.id() for key in reg_keys.get_result()],
+            sessionKeysWishList=[key.id() for key in wish_keys.get_result()])
 
 
-    def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+    def _context(self):
+        """Return the RequestContext of the request being served."""
+        request_id = os.environ.get('REQUEST_LOG_ID')
+        ctx = getattr(self, '_requestContext', None)
+        if ctx is None or ctx.requestId != request_id:
+            ctx = self._requestContext = RequestContext(request_id)
+        return ctx
+
+
+    def _getCurrentUser(self):
+        """Return (user, user_id) of the caller; raise if not signed in."""
+        return self._context().resolveUser()
+
+
+    def _getProfileFromUser(self, forUpdate=False):
+        """Return user Profile from datastore, creating new one if non-existent.
+        With forUpdate a new Profile is only marked dirty, and the caller
+        writes it together with its own changes."""
+        ctx = self._context()
+        if ctx.profile:
+            return ctx.profile
+        user, user_id = ctx.resolveUser()
 
         # get Profile from datastore
-        user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
         # create new Profile if not there
@@ -190,24 +316,55 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            ctx.markDirty(profile)
+            if not forUpdate:
+                ctx.flush()
+        elif profile.conferenceKeysToAttend or profile.sessionKeysWishList:
+            profile = self._migrateProfile(p_key)
 
+        ctx.profile = profile
         return profile      # return Profile
 
 
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfile(p_key):
+        """Move a Profile's legacy conferenceKeysToAttend/sessionKeysWishList
+        strings into Registration/WishlistEntry children; used lazily by
+        _getProfileFromUser & by the /tasks/migrate_profiles job."""
+        prof = p_key.get()
+        entities = [Registration(id=wsck, parent=p_key,
+                        conference=ndb.Key(urlsafe=wsck))
+                    for wsck in prof.conferenceKeysToAttend]
+        for wssk in prof.sessionKeysWishList:
+            s_key = ndb.Key(urlsafe=wssk)
+            entities.append(WishlistEntry(id=wssk, parent=p_key,
+                session=s_key, conference=s_key.parent()))
+        if entities:
+            prof.conferenceKeysToAttend = []
+            prof.sessionKeysWishList = []
+            ndb.put_multi(entities + [prof])
+        return prof
+
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
-        prof = self._getProfileFromUser()
+        ctx = self._context()
+        prof = self._getProfileFromUser(forUpdate=True)
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
-                    if val:
+                    if val and getattr(prof, field) != str(val):
                         setattr(prof, field, str(val))
-                        prof.put()
+                        ctx.markDirty(prof)
+                        if field == 'displayName':
+                            cache.organizerNames.delete(prof.key)
+        # at most one write, & none when nothing changed
+        ctx.flush()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -215,6 +372,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumentation.instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -222,6 +380,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumentation.instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -231,30 +390,68 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return CONFERENCE_CONVERTER.copy(conf, websafeKey=conf.key.urlsafe(),
+            organizerDisplayName=displayName or None)
+
+
+    def _getOrganizerNames(self, conferences):
+        """Return a dict mapping organizer Profile key to displayName for
+        the given conferences, fetching all uncached organizers with a
+        single get_multi."""
+        return self._getOrganizerNamesAsync(
+            set(conf.key.parent() for conf in conferences)).get_result()
+
+    @ndb.tasklet
+    def _getOrganizerNamesAsync(self, p_keys):
+        """Tasklet behind _getOrganizerNames, taking organizer Profile keys."""
+        names = {}
+        missing = []
+        for p_key in p_keys:
+            name = cache.organizerNames.get(p_key)
+            if name is None:
+                missing.append(p_key)
+            else:
+                names[p_key] = name
+        profiles = yield ndb.get_multi_async(missing)
+        for p_key, prof in zip(missing, profiles):
+            name = getattr(prof, 'displayName', None) or ""
+            cache.organizerNames.set(p_key, name)
+            names[p_key] = name
+        raise ndb.Return(names)
+
+    def _copyConferencesToForms(self, conferences, nextPageToken=None,
+                                fields=None):
+        """Copy Conferences to ConferenceForms, organizer names included
+        unless a fields mask leaves them out."""
+        names = {}
+        if fields is None or 'organizerDisplayName' in fields:
+            names = self._getOrganizerNames(conferences)
+        return ConferenceForms(
+            items=CONFERENCE_CONVERTER.copyAll(conferences, lambda conf: {
+                'websafeKey': conf.key.urlsafe(),
+                'organizerDisplayName': names.get(conf.key.parent()) or None},
+                fields),
+            nextPageToken=nextPageToken
+        )
 
+    def _fieldMask(self, fields, message):
+        """Check a requested list of message field names; return it as a
+        frozenset, or None when all fields are wanted."""
+        if not fields:
+            return None
+        known = set(field.name for field in message.all_fields())
+        unknown = [name for name in fields if name not in known]
+        if unknown:
+            raise endpoints.BadRequestException(
+                "Unknown field(s) in 'fields': %s" % ', '.join(unknown))
+        return frozenset(fields)
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
 
+    @staticmethod
+    def _conferenceDataFromForm(request):
+        """Validate a ConferenceForm & return its fields as Conference
+        properties, filling in defaults on both; used by createConference
+        & the bulk import task."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
@@ -283,6 +480,14 @@ class ConferenceApi(remote.Service):
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
             setattr(request, "seatsAvailable", data["maxAttendees"])
+        return data
+
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user, user_id = self._getCurrentUser()
+        data = self._conferenceDataFromForm(request)
 
         # make Profile Key from user ID
         p_key = ndb.Key(Profile, user_id)
@@ -293,8 +498,17 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # split the seats over shards so registrations don't contend
+        shards = seats.newShards(c_key, data['seatsAvailable'])
+        data['seatShards'] = len(shards)
+
+        # create Conference & return (modified) ConferenceForm; conference
+        # names are unique, so claim the name in the same transaction
+        if not names.claimAndPutAsync(data['name'], c_key,
+                                      [Conference(**data)] + shards).get_result():
+            raise ConflictException(
+                "A conference named '%s' already exists." % data['name'])
+        cache.bumpConferenceGeneration()
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
@@ -302,124 +516,247 @@ class ConferenceApi(remote.Service):
 
         return request
 
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning SessionForm/request.  open only to the organizer of the conference"""
-        """Ideally, create the session as a child of the conference. """
-        print ("In _createSessionObject")
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-        print("user_id: {}", user_id)
-        print("user: {}", repr(user))
+    def _sessionDataFromForm(self, request):
+        """Validate a SessionForm & return its fields as Session properties."""
+        if not request.name:
+            raise endpoints.BadRequestException("Session 'name' field required")
 
-        # copy ConferenceForm/ProtoRPC Message into dict
+        # copy SessionForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        print("data: {}", repr(data))
-
         del data['websafeKey']
         del data['isWishlist']
+        data.pop('websafeConferenceKey', None)
+
+        # combine the startDate & startTime strings into one datetime
+        try:
+            if data['startDate']:
+                data['startdatetime'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d")
+            if data['startTime']:
+                start_time = data['startTime'].strip()
+                start_time = datetime.strptime(start_time,
+                    "%H:%M:%S" if start_time.count(':') == 2 else "%H:%M").time()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid session startDate or startTime.")
+        if data['startTime']:
+            if not data['startDate']:
+                raise endpoints.BadRequestException(
+                    "Session startTime needs a startDate.")
+            data['startdatetime'] = datetime.combine(
+                data['startdatetime'].date(), start_time)
+            data['hasStartTime'] = True
+        del data['startDate']
+        del data['startTime']
+        return data
 
-        conf_name = data['conferenceName']
-        print("conf_name: {}", conf_name)
-
-        q = Conference.query()
-        q= q.filter(Conference.name == conf_name)
+    def _createSessionObject(self, request):
+        """Create Session object, returning its SessionForm.  open only to the organizer of the conference"""
+        """Ideally, create the session as a child of the conference. """
+        return self._createSessionObjectAsync(request).get_result()
 
-        conf = q.get()
+    @ndb.tasklet
+    def _createSessionObjectAsync(self, request):
+        """Tasklet behind _createSessionObject."""
+        # preload necessary data items
+        user, user_id = self._getCurrentUser()
+        data = self._sessionDataFromForm(request)
+
+        # the parent is named by its key; legacy callers give its name
+        if request.websafeConferenceKey:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        elif data['conferenceName']:
+            conf_key = names.lookupName(data['conferenceName'])
+        else:
+            conf_key = None
+        conf = None
+        if conf_key:
+            conf = yield conf_key.get_async()
         if not conf:
-            raise endpoints.UnauthorizedException('Session must belong to a conference.')
-
-        print("conf: {}", repr(conf))
+            raise endpoints.NotFoundException('Session must belong to a conference.')
+        data['conferenceName'] = conf.name
 
         if user_id != conf.organizerUserId:
             raise endpoints.BadRequestException("Session parent must be the same as the current user.")
 
-        if not request.name:
-            raise endpoints.BadRequestException("Session 'name' field required")
-
-
-        # convert dates from strings to Date objects; 
-        if data['startDate']:
-            data['startdatetime'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'][:10], "%h:%m:%s").time()
-            data['startdatetime'] = datetime.datetime.combine(data['startdatetime'], data['startTime'])
-        del data['startDate']
-        del data['startTime']
-
-
-        # allocate new Session ID with Conference key as parent
-        s_id = Session.allocate_ids(size=1, parent=conf.key)[0]
-        # make Session key from ID
-        s_key = ndb.Key(Session, s_id, parent=conf.key)
-        data['key'] = s_key
-        # data['organizerUserId'] = request.organizerUserId = user_id
-
-        # create Session & return (modified) SessionForm
-        Session(**data).put()
+        # create Session with Conference key as parent & return its
+        # SessionForm; the put allocates the new ID itself, saving the
+        # allocate_ids round trip
+        sess = Session(parent=conf.key, **data)
+        yield sess.put_async()
+        yield self._indexSessionsAsync([sess])
         # taskqueue.add(params={'email': user.email(),
         #     'conferenceInfo': repr(request)},
         #     url='/tasks/send_confirmation_email'
         # )
 
-        return request
+        raise ndb.Return(self._copySessionToForm(sess))
 
-# - - - Session objects - - - - - - - - - - - - - - - - - - -
+    def _createSessionObjects(self, request):
+        """Create many Sessions of one conference at once, returning the
+        outcome of each SessionForm in request order. Open only to the
+        organizer of the conference."""
+        user, user_id = self._getCurrentUser()
+        if len(request.items) > MAX_BULK_SESSIONS:
+            raise endpoints.BadRequestException(
+                "At most %d sessions can be created at once." % MAX_BULK_SESSIONS)
 
-    def IsInWishlist(self, sessKey):
-        """is session in user's wishlist."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-        print ("In _isInWishlist, sessKey: {}", repr(sessKey))
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
-        sess = ndb.Key(urlsafe=sessKey).get()
-        if not sess:
-            raise endpoints.NotFoundException('No session found with key: %s' % sessKey)
-        return (sessKey in prof.sessionKeysWishList)
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can add sessions to the conference.')
 
-    def _copySessionToForm(self, sess):
-        """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sess, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sess, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, sess.key.urlsafe())
-            elif field.name == "isWishlist":
-                setattr(sf, field.name, self.IsInWishlist(sess.key.urlsafe()))
-        sf.check_initialized()
-        return sf
+        # validate everything first; invalid items are reported, not written
+        results = [SessionCreateResult() for sf in request.items]
+        valid = []
+        for result, sf in zip(results, request.items):
+            try:
+                data = self._sessionDataFromForm(sf)
+            except endpoints.BadRequestException as e:
+                result.error = str(e)
+                continue
+            data['conferenceName'] = conf.name
+            valid.append((result, data))
+        if not valid:
+            return SessionCreateResults(items=results)
+
+        # one ID allocation for the whole program
+        first, last = Session.allocate_ids(size=len(valid), parent=conf.key)
+        sessions = []
+        for s_id, (result, data) in zip(range(first, last + 1), valid):
+            data['key'] = ndb.Key(Session, s_id, parent=conf.key)
+            sessions.append(Session(**data))
+
+        # write in bounded batches, all in flight at once
+        futures = []
+        for i in range(0, len(sessions), SESSION_PUT_BATCH_SIZE):
+            futures.extend(ndb.put_multi_async(sessions[i:i + SESSION_PUT_BATCH_SIZE]))
+        saved = []
+        for (result, data), future, sess in zip(valid, futures, sessions):
+            if future.get_exception():
+                result.error = 'Could not save session: %s' % future.get_exception()
+            else:
+                result.websafeKey = future.get_result().urlsafe()
+                saved.append(sess)
+        self._indexSessionsAsync(saved).get_result()
+        return SessionCreateResults(items=results)
 
-    def _getSessionQuery(self, q, inequality_filter, filters):
-        """Return formatted query from the submitted filters."""
-        print("in _getSessionQuery")
+    @staticmethod
+    @ndb.tasklet
+    def _indexSessionsAsync(sessions):
+        """Add saved Sessions to the Speaker index. The sessions are
+        already written, so a contended index update must not fail the
+        request; /tasks/index_speakers indexes them later instead."""
+        try:
+            yield speakers.indexSessionsAsync(sessions)
+        except datastore_errors.TransactionFailedError as e:
+            log.warning('Speaker index update deferred for %d sessions: %s',
+                        len(sessions), e)
+            taskqueue.add(params={'session': [sess.key.urlsafe()
+                                              for sess in sessions]},
+                          url='/tasks/index_speakers')
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-        print("done with q.order")
+# - - - Session objects - - - - - - - - - - - - - - - - - - -
 
-        for filtr in filters:
-            if filtr["field"] in ["duration"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+    def _copySessionToForm(self, sess, wishlist=()):
+        """Copy relevant fields from Session to SessionForm."""
+        return self._copySessionList([sess], wishlist)[0]
+
+    def _copySessionList(self, sessions, wishlist=(), fields=None):
+        """Copy Sessions to a list of SessionForms in one pass."""
+        def extra(sess):
+            wssk = sess.key.urlsafe()
+            values = {'websafeKey': wssk, 'isWishlist': wssk in wishlist}
+            if sess.startdatetime:
+                values['startDate'] = str(sess.startdatetime.date())
+                if sess.hasStartTime:
+                    values['startTime'] = sess.startdatetime.strftime('%H:%M')
+            return values
+        return SESSION_CONVERTER.copyAll(sessions, extra, fields)
+
+    def _copySessionsToForms(self, sessions, prof=None, nextPageToken=None,
+                             fields=None):
+        """Copy Sessions to SessionForms, checking the user's wishlist for
+        the whole listing with one batch lookup unless a fields mask
+        leaves isWishlist out."""
+        wishlist = set()
+        if fields is None or 'isWishlist' in fields:
+            if prof is None:
+                prof = self._getProfileFromUser() # get user Profile
+            entries = ndb.get_multi([ndb.Key(WishlistEntry, sess.key.urlsafe(),
+                parent=prof.key) for sess in sessions])
+            wishlist = set(entry.key.id() for entry in entries if entry)
+        return SessionForms(
+            items=self._copySessionList(sessions, wishlist, fields),
+            nextPageToken=nextPageToken
+        )
 
-    def _getQuery(self, request):
+    def _fetchPage(self, q, request, residual=(), projection=None):
+        """Fetch one page of query results using the request's pageSize and
+        pageToken; return (entities, nextPageToken). Results are streamed
+        through the residual filters left over by the query planner; at most
+        MAX_SCANNED_PER_PAGE results are read, so a page may come back short
+        with a nextPageToken. A projection fetches only those properties."""
+        page_size = self._pageSize(request)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = ndb.Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException(
+                    "Invalid 'pageToken': %s" % request.pageToken)
+        options = {}
+        if projection:
+            options['projection'] = projection
+        if not residual:
+            results, next_cursor, more = q.fetch_page(page_size,
+                start_cursor=cursor, **options)
+            if more and next_cursor:
+                return results, next_cursor.urlsafe()
+            return results, None
+
+        results = []
+        scanned = 0
+        it = q.iter(start_cursor=cursor, produce_cursors=True,
+                    batch_size=page_size, **options)
+        for entity in it:
+            scanned += 1
+            if planner.matches(entity, residual):
+                results.append(entity)
+            if len(results) == page_size or scanned == MAX_SCANNED_PER_PAGE:
+                break
+        if scanned and it.has_next():
+            return results, it.cursor_after().urlsafe()
+        return results, None
+
+    def _pageSize(self, request):
+        """Return the request's checked pageSize."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be between 1 and %d." % MAX_PAGE_SIZE)
+        return page_size
+
+    def _fetchKeysPage(self, keys, request):
+        """Fetch one page of the entities of a list of keys using the
+        request's pageSize and pageToken, an offset into the list; return
+        (entities, nextPageToken). Keys of deleted entities are skipped."""
+        page_size = self._pageSize(request)
+        try:
+            start = int(request.pageToken or 0)
+            if start < 0:
+                raise ValueError(start)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid 'pageToken': %s" % request.pageToken)
+        end = start + page_size
+        entities = [entity for entity in ndb.get_multi(keys[start:end]) if entity]
+        return entities, (str(end) if end < len(keys) else None)
+
+    def _getSessionQuery(self, q, inequality_filter, filters):
         """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
@@ -427,33 +764,37 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        # finish with the key order so "!=" filters still produce page cursors
+        q = q.order(Session.key)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
+            if filtr["field"] in ["duration"]:
                 filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
         return q
 
-
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
-        print("in _formatFilters")
         formatted_filters = []
         inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-            print("about to get field and operator")
 
             try:
                 filtr["field"] = FIELDS[filtr["field"]]
                 filtr["operator"] = OPERATORS[filtr["operator"]]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s needs an integer value." % filtr["field"])
 
             # Every operation except "=" is an inequality
-            print("about to check operator")
             if filtr["operator"] != "=":
                 # check if inequality operation has been used in previous filters
                 # disallow the filter if inequality was performed on a different field before
@@ -468,25 +809,19 @@ class ConferenceApi(remote.Service):
 
     def _formatFiltersSession(self, filters):
         """Parse, check validity and format user supplied filters."""
-        print("in _formatFiltersSession")
         formatted_filters = []
         inequality_field = None
 
         for f in filters:
-            print("filter f: {}", repr(f))
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-            print("about to get field and operator")
-            print("field: {}", filtr["field"])
             try:
                 if (filtr["field"] != "websafeConferenceKey"):
-                    print("field translated: {}", SESSION_FIELDS[filtr["field"]])
                     filtr["field"] = SESSION_FIELDS[filtr["field"]]
                 filtr["operator"] = OPERATORS[filtr["operator"]]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
             # Every operation except "=" is an inequality
-            print("about to check operator")
             if filtr["operator"] != "=":
                 # check if inequality operation has been used in previous filters
                 # disallow the filter if inequality was performed on a different field before
@@ -500,12 +835,9 @@ class ConferenceApi(remote.Service):
         return (inequality_field, formatted_filters)
 
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._getCurrentUser()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -522,10 +854,26 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # move the conference's claim on its name along with a rename
+        if request.name and \
+                names.normalize(request.name) != names.normalize(conf.name):
+            names.claimName(request.name, conf.key)
+            names.releaseName(conf.name, conf.key)
+
+        # seatsAvailable is derived from the seat shards; a change to
+        # maxAttendees adds or removes seats across the shards instead
+        conf = seats.ensureShards(conf)
+        if request.maxAttendees is not None and \
+                request.maxAttendees != conf.maxAttendees:
+            conf.seatsAvailable = seats.adjustSeats(
+                conf, request.maxAttendees - (conf.maxAttendees or 0))
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
+            if field.name == 'seatsAvailable':
+                continue
             # only copy fields where we get data
             if data not in (None, []):
                 # special handling for dates (convert string to Date)
@@ -536,18 +884,49 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
+        # drop the cached detail view & refresh the announcement set once
+        # the update has committed
+        def updateCaches():
+            cache.invalidateConferenceForm(request.websafeConferenceKey)
+            cache.bumpConferenceGeneration()
+            announcements.seatsChanged(conf, conf.seatsAvailable)
+        ndb.get_context().call_on_commit(updateCaches)
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
+    @ndb.transactional(xg=True)
+    def _deleteConferenceObject(self, request):
+        """Delete a Conference right away; its Sessions, Registrations,
+        wishlist entries & seat shards follow in a background job."""
+        user, user_id = self._getCurrentUser()
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+
+        deletion.markDeleted(conf)
+        def updateCaches():
+            cache.invalidateConferenceForm(request.websafeConferenceKey)
+            cache.bumpConferenceGeneration()
+            announcements.seatsChanged(conf, 0)
+        ndb.get_context().call_on_commit(updateCaches)
+        return self._copyConferenceToForm(conf, None)
+
+
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm, path='conference',
             http_method='DELETE', name='deleteConference')
+    @instrumentation.instrumented
     def deleteConference(self, request):
-        """Delete new conference."""
+        """Delete a conference & everything that belongs to it."""
         return self._deleteConferenceObject(request)
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumentation.instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -555,72 +934,77 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumentation.instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences', http_method='POST', name='queryConferences')
+    @instrumentation.instrumented
     def queryConferences(self, request):
         """Query for conferences."""
-        print("request: {}", repr(request))
-        conferences = self._getQuery(request)
+        log.debug("queryConferences filters: %r", request.filters)
+        # the planner picks the inequality itself; see planner.py
+        _, filters = self._formatFilters(request.filters)
+        fields = self._fieldMask(request.fields, ConferenceForm)
+
+        # identical filter sets, in any order, share one cached result page
+        shape, cache_key = cache.conferenceQueryKey(
+            filters, request.pageSize, request.pageToken, fields)
+        forms = cache.getConferenceQuery(shape, cache_key)
+        if forms:
+            return forms
+
+        started = time.time()
+        q, residual, projection = planner.planConferenceQuery(filters, fields)
+        conferences, next_token = self._fetchPage(q, request, residual, projection)
 
          # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") \
-            for conf in conferences]
-        )
+        forms = self._copyConferencesToForms(conferences, next_token, fields)
+        cache.setConferenceQuery(shape, cache_key, forms, time.time() - started)
+        return forms
         
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumentation.instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        print("in getConferencesCreated")
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        prof = self._getProfileFromUser()
 
-        # make profile key
-        p_key = ndb.Key(Profile, getUserId(user))
         # create ancestor query for this user
-        conferences = Conference.query(ancestor=p_key)
-        # get the user profile and display name
-        prof = p_key.get()
+        conferences, next_token = self._fetchPage(
+            Conference.query(ancestor=prof.key), request)
+        # get the display name from the user profile
         displayName = getattr(prof, 'displayName')
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, displayName) for conf in conferences]
+            items=CONFERENCE_CONVERTER.copyAll(conferences, lambda conf: {
+                'websafeKey': conf.key.urlsafe(),
+                'organizerDisplayName': displayName or None},
+                self._fieldMask(request.fields, ConferenceForm)),
+            nextPageToken=next_token
         )
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @instrumentation.instrumented
     def filterPlayground(self, request):
-        q = Conference.query()
-        # simple filter usage:
-        # q = q.filter(Conference.city == "Paris")
-
-        # advanced filter building and usage
-        field = "city"
-        operator = "="
-        value = "London"
-        f = ndb.query.FilterNode(field, operator, value)
-        q = q.filter(f)
-
-        # TODO
-        # add 2 filters:
-        # 1: city equals to London
-        # 2: topic equals "Medical Innovations"
-        q= q.filter(Conference.topics == "Web Technologies")
-        q = q.order(Conference.name)
-        q= q.filter(Conference.maxAttendees > 6)
+        # advanced filter building and usage; the planner picks which
+        # filters the datastore runs
+        filters = [
+            {"field": "city", "operator": "=", "value": "London"},
+            {"field": "topics", "operator": "=", "value": "Web Technologies"},
+            {"field": "maxAttendees", "operator": ">", "value": 6},
+        ]
+        fields = self._fieldMask(request.fields, ConferenceForm)
+        q, residual, projection = planner.planConferenceQuery(filters, fields)
 
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
-        )
+        conferences, next_token = self._fetchPage(q, request, residual, projection)
+        return self._copyConferencesToForms(conferences, next_token, fields)
 
 
 # - - - Sessions - - - - - - - - - - - - - - - - - - - -
@@ -637,31 +1021,25 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(SessionQueryForms, SessionForms, path='getConferenceSessions',
             http_method='POST', name='getConferenceSessions')
+    @instrumentation.instrumented
     def getConferenceSessions(self, request):
         """ Given a conference, return all sessions """
-        print("in getConferenceSessions")
-        print("request: {}", repr(request))
         # print("request.websafeConferenceKey: {}", repr(request.websafeConferenceKey))
 
         inequality_filter, filters = self._formatFiltersSession(request.filters)
-        print("filters: {}", repr(filters))
+        log.debug("getConferenceSessions filters: %r", filters)
 
         conf_key = ndb.Key(urlsafe= filters[0]["value"])
         # conf_key = ndb.Key(urlsafe= request.websafeConferenceKey)
         conf = conf_key.get()
-        print("conf: {}", repr(conf))
         if not conf:                                                                                                                                                               raise endpoints.NotFoundException(
             'No conference found with key: %s' % filters[0]["value"])
         filters.pop(0)
             # 'No conference found with key: %s' % request.websafeConferenceKey)
         sessionsQuery = Session.query(ancestor=conf.key)
-        print("request.filters: {}", repr(request.filters))
         # sessions = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
         if filters:
             sessionsQuery = self._getSessionQuery(sessionsQuery, inequality_filter, filters) 
-        if sessionsQuery:
-            session = sessionsQuery.get()
-        print("session: {}", session)
         # response = SESS_CONF_RESPONSE()
         # # print("session dict: {}", session.to_JSON())
         # response.email = self._copySessionToForm(session)
@@ -672,23 +1050,25 @@ class ConferenceApi(remote.Service):
         #  fetch sessions from datastore. 
         # sessions = ndb.Key(urlsafe=request.websafeConferenceKey).get())
 
-        # return set of ConferenceForm objects per Conference
-        return SessionForms(items=[self._copySessionToForm(sess)\
-            for sess in sessionsQuery]
-        )
+        # return one page of SessionForm objects
+        sessions, next_token = self._fetchPage(sessionsQuery, request)
+        return self._copySessionsToForms(sessions, nextPageToken=next_token,
+            fields=self._fieldMask(request.fields, SessionForm))
 
 
     @endpoints.method(SESS_TYPE_GET_REQUEST, SessionForms, path='session/bytype',
             http_method='GET', name='getSessionsByType')
+    @instrumentation.instrumented
     def getSessionsByType(self, request):
         """ Given a session type, return all sessions given of this type, across all conferences """
-        sessions = Session.query(Session.typeOfSession == request.type)
-        return SessionForms(items=[self._copySessionToForm(sess)\
-            for sess in sessions]
-        )
+        sessions, next_token = self._fetchPage(
+            Session.query(Session.typeOfSession == request.type), request)
+        return self._copySessionsToForms(sessions, nextPageToken=next_token,
+            fields=self._fieldMask(request.fields, SessionForm))
 
     @endpoints.method(SESS_CONF_TYPE_GET_REQUEST, SessionForms, path='session/bytypeinconference',
             http_method='GET', name='getConferenceSessionsByType')
+    @instrumentation.instrumented
     def getConferenceSessionsByType(self, request):
         """ Given a conference, return all sessions of a specified type (eg lecture, keynote, workshop) """
         # conf = ndb.Key(urlsafe=websafeConferenceKey).get()
@@ -706,93 +1086,182 @@ class ConferenceApi(remote.Service):
         conf = conf_key.get()
         if not conf:                                                                                                                                                               raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).filter(Session.typeOfSession == request.type)
-        return SessionForms(items=[self._copySessionToForm(sess)\
-            for sess in sessions]
-        )
+        sessions, next_token = self._fetchPage(
+            Session.query(ancestor=conf.key).filter(Session.typeOfSession == request.type), request)
+        return self._copySessionsToForms(sessions, nextPageToken=next_token,
+            fields=self._fieldMask(request.fields, SessionForm))
 
     @endpoints.method(SESS_SPKR_GET_REQUEST, SessionForms, path='session/byspeaker',
             http_method='GET', name='getSessionsBySpeaker')
+    @instrumentation.instrumented
     def getSessionsBySpeaker(self, request):
         """ Given a speaker, return all sessions given by this particular speaker, across all conferences """
-        sessions = Session.query(Session.speaker == request.speaker)
-        return SessionForms(items=[self._copySessionToForm(sess)\
-            for sess in sessions]
-        )
+        # one get of the speaker's index, one get_multi of the page
+        sessions, next_token = self._fetchKeysPage(
+            speakers.getSessionKeysAsync(request.speaker).get_result(), request)
+        return self._copySessionsToForms(sessions, nextPageToken=next_token,
+            fields=self._fieldMask(request.fields, SessionForm))
 
     @endpoints.method(SESS_CONF_SPKR_GET_REQUEST, SessionForms, path='session/byspeakerinconference',
             http_method='GET', name='getConferenceSessionsBySpeaker')
+    @instrumentation.instrumented
     def getConferenceSessionsBySpeaker(self, request):
         """ Given a speaker, return all sessions given by this particular speaker, across all conferences """
         conf_key = ndb.Key(urlsafe= request.websafeConferenceKey)
-        conf = conf_key.get()
-        if not conf:                                                                                                                                                               raise endpoints.NotFoundException(
+        conf_future = conf_key.get_async()
+        s_keys = speakers.getSessionKeysAsync(request.speaker).get_result()
+        if not conf_future.get_result():
+            raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        sessions = Session.query(ancestor=conf.key).filter(Session.speaker == request.speaker)
-        return SessionForms(items=[self._copySessionToForm(sess)\
-            for sess in sessions]
-        )
-
-    @endpoints.method(SessionForm, SessionForm, path='session',
+        # the speaker's sessions in this conference are the keys it parents
+        sessions, next_token = self._fetchKeysPage(
+            [s_key for s_key in s_keys if s_key.parent() == conf_key], request)
+        return self._copySessionsToForms(sessions, nextPageToken=next_token,
+            fields=self._fieldMask(request.fields, SessionForm))
+
+    @endpoints.method(SESS_TIME_GET_REQUEST, SessionForms, path='session/bytime',
+            http_method='GET', name='getSessionsByTime')
+    @instrumentation.instrumented
+    def getSessionsByTime(self, request):
+        """ Return sessions starting before a given hour, leaving out the given session types, across all conferences or in one """
+        if not request.startsBefore or not 0 < request.startsBefore <= 24:
+            raise endpoints.BadRequestException(
+                "'startsBefore' must be an hour between 1 and 24.")
+        excluded = set(t.strip().lower() for t in request.excludeTypes)
+        if not excluded <= set(SESSION_TYPES):
+            raise endpoints.BadRequestException(
+                "'excludeTypes' must be among: %s" % ', '.join(SESSION_TYPES))
+
+        # both conditions are equality/IN filters on precomputed fields,
+        # so the datastore answers from an index instead of us filtering
+        if request.websafeConferenceKey:
+            q = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        else:
+            q = Session.query()
+        q = q.filter(Session.startsBeforeHour == request.startsBefore)
+        if excluded:
+            types = [t for t in SESSION_TYPES if t not in excluded]
+            if not types:
+                return SessionForms()
+            q = q.filter(Session.sessionType.IN(types))
+        q = q.order(Session.name, Session.key)
+
+        sessions, next_token = self._fetchPage(q, request)
+        return self._copySessionsToForms(sessions, nextPageToken=next_token,
+            fields=self._fieldMask(request.fields, SessionForm))
+
+    @endpoints.method(SESS_POST_REQUEST, SessionForm, path='session',
             http_method='POST', name='createSession')
+    @instrumentation.instrumented
     def createSession(self, request):
         """ open only to the organizer of the conference """
         return self._createSessionObject(request)
 
+    @endpoints.method(SESS_BULK_POST_REQUEST, SessionCreateResults,
+            path='conference/{websafeConferenceKey}/sessions',
+            http_method='POST', name='createSessions')
+    @instrumentation.instrumented
+    def createSessions(self, request):
+        """ Create many sessions of a conference; open only to its organizer """
+        return self._createSessionObjects(request)
+
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
     @ndb.transactional(xg=True)
+    def _registerWithShard(self, p_key, conf_key, shard_key, pending=()):
+        """Take a seat from one shard and record the Registration, writing
+        the pending entities (a new Profile) in the same commit; return
+        False if the shard has run out of seats."""
+        reg_key = ndb.Key(Registration, conf_key.urlsafe(), parent=p_key)
+        # check if user already registered otherwise add
+        if reg_key.get():
+            raise ConflictException(
+                "You have already registered for this conference")
+        shard = seats.takeSeat(shard_key)
+        if not shard:
+            return False
+        ndb.put_multi([Registration(key=reg_key, conference=conf_key), shard]
+                      + list(pending))
+        return True
+
+    @ndb.transactional(xg=True)
+    def _unregisterWithShard(self, p_key, conf_key, shard_key):
+        """Give a seat back to one shard and delete the Registration;
+        return False if the user was not registered."""
+        reg_key = ndb.Key(Registration, conf_key.urlsafe(), parent=p_key)
+        if not reg_key.get():
+            return False
+        reg_key.delete()
+        seats.returnSeat(shard_key).put()
+        return True
+
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        ctx = self._context()
+        user, user_id = self._getCurrentUser()
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % wsck)
 
-        # register
-        if reg:
-            # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+        # fetch the conference & look for an existing registration while
+        # the Profile is loaded; the transaction below re-checks the latter
+        conf_future = ndb.Key(urlsafe=wsck).get_async()
+        reg_future = ndb.Key(Registration, wsck,
+            parent=ndb.Key(Profile, user_id)).get_async()
+        prof = self._getProfileFromUser(forUpdate=True) # get user Profile
+        # a new Profile is committed with the Registration, or on its own
+        # if nothing else gets written
+        pending = ctx.takeDirty()
+        try:
+            # check if conf exists given websafeConfKey
+            conf = conf_future.get_result()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % wsck)
+            if reg and reg_future.get_result():
                 raise ConflictException(
                     "You have already registered for this conference")
+            conf = seats.ensureShards(conf)
+
+            # register: each attempt is a transaction over the Profile and a
+            # single seat shard, so concurrent registrations rarely collide
+            if reg:
+                for shard_key in seats.shardsWithSeats(conf):
+                    if self._registerWithShard(prof.key, conf.key, shard_key,
+                                               pending):
+                        pending = []
+                        retval = True
+                        break
+                else:
+                    raise ConflictException(
+                        "There are no seats available.")
+                self._seatsChanged(conf, -1)
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable = max(0, conf.seatsAvailable - 1)
-            retval = True
-
-        # unregister
-        else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
-
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
+            # unregister
             else:
-                retval = False
+                retval = self._unregisterWithShard(
+                    prof.key, conf.key, seats.randomShard(conf))
+                if retval:
+                    self._seatsChanged(conf, 1)
+        finally:
+            if pending:
+                ndb.put_multi(pending)
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
         return BooleanMessage(data=retval)
 
+    def _seatsChanged(self, conf, delta):
+        """Propagate a committed registration change to the caches and
+        the nearly sold out announcement."""
+        total = seats.seatsChanged(conf.key, delta)
+        if total is None:
+            total = seats.getSeatsAvailable(conf)
+        cache.invalidateConferenceForm(conf.key.urlsafe())
+        announcements.seatsChanged(conf, total)
+
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/register/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumentation.instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -800,51 +1269,65 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/unregister/{websafeConferenceKey}',
             http_method='POST', name='unregisterFromConference')
+    @instrumentation.instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, False)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumentation.instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         # TODO:
         # step 1: get user profile
         prof = self._getProfileFromUser() # get user Profile
-        # step 2: get conferenceKeysToAttend from profile.
-        # to make a ndb key from websafe key you can use:
-        # ndb.Key(urlsafe=my_websafe_key_string)
-        keys_to_attend = []
-        for rawKey in prof.conferenceKeysToAttend:
-            key = ndb.Key(urlsafe=rawKey)
-            print("rawKey: {}", rawKey)
-            keys_to_attend.append(key)
-        # step 3: fetch conferences from datastore. 
-        # for ndbKey in keys_to_attend:
-        #     conf = ndbKey.get()
+        # step 2: get the conference keys from the Registration children,
+        # whose ids are the conferences' websafe keys
+        keys_to_attend = [ndb.Key(urlsafe=reg_key.id()) for reg_key in
+            Registration.query(ancestor=prof.key).fetch(keys_only=True)]
+        # step 3: fetch one page of conferences from datastore. 
         # Use get_multi(array_of_keys) to fetch all keys at once.
-        # Do not fetch them one by one!
-        conferences = ndb.get_multi(keys_to_attend)
+        # Do not fetch them one by one! Registrations for conferences that
+        # no longer exist are skipped; the reference sweep prunes them
+        conferences, next_token = self._fetchKeysPage(keys_to_attend, request)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, "")\
-            for conf in conferences]
-        )
+        return self._copyConferencesToForms(conferences, next_token,
+            self._fieldMask(request.fields, ConferenceForm))
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumentation.instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:                                                                                                                                                               raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # serve from memcache when we can
+        cf = cache.getConferenceForm(request.websafeConferenceKey)
+        if cf:
+            return cf
+        cf = self._getConferenceFormAsync(
+            ndb.Key(urlsafe=request.websafeConferenceKey)).get_result()
+        # cache & return ConferenceForm
+        cache.setConferenceForm(request.websafeConferenceKey, cf)
+        return cf
+
+    @ndb.tasklet
+    def _getConferenceFormAsync(self, conf_key):
+        """Fetch a Conference and its organizer's name concurrently (the
+        organizer's Profile key is the conference key's parent) and
+        return its ConferenceForm with the live seat count."""
+        conf, names = yield (conf_key.get_async(),
+                             self._getOrganizerNamesAsync([conf_key.parent()]))
+        # bail if not found
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % conf_key.urlsafe())
+        # show the live seat count rather than the periodically synced one
+        conf.seatsAvailable = yield seats.getSeatsAvailableAsync(conf)
+        raise ndb.Return(self._copyConferenceToForm(conf, names[conf_key.parent()]))
 
 # - - - Session wishlists - - - - - - - - - - - - - - - - - -
 
@@ -852,7 +1335,6 @@ class ConferenceApi(remote.Service):
         """is session in user's wishlist."""
         retval = None
         prof = self._getProfileFromUser() # get user Profile
-        print ("In _isUserWishing, request: {}", repr(request))
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wssk = request.websafeSessionKey
@@ -861,51 +1343,53 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
 
-        return BooleanMessage(data=wssk in prof.sessionKeysWishList)
+        entry = ndb.Key(WishlistEntry, wssk, parent=prof.key).get()
+        return BooleanMessage(data=entry is not None)
 
     # not truly a toggle function, add parameter determines which way to go, add or remove
     def _toggleSessionWishlist(self, request, add=True):
         """Add or remove session to/from user's wishlist."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
-        print ("In _sessionWishlist, request: {}", repr(request))
+        ctx = self._context()
+        prof = self._getProfileFromUser(forUpdate=True) # get user Profile
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wssk = request.websafeSessionKey
-        sess = ndb.Key(urlsafe=wssk).get()
-        if not sess:
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % wsck)
-
-        # add
-        if add:
-            # check if user already wishing for this session otherwise add
-            if wssk in prof.sessionKeysWishList:
-                raise ConflictException(
-                    "You are already interested in this session")
-
-            # register user, take away one seat
-            prof.sessionKeysWishList.append(wssk)
-            retval = True
-
-        # unregister
-        else:
-            # check if user already registered
-            if wssk in prof.sessionKeysWishList:
-
-                # unregister user, add back one seat
-                prof.sessionKeysWishList.remove(wssk)
+        try:
+            sess = ndb.Key(urlsafe=wssk).get()
+            if not sess:
+                raise endpoints.NotFoundException(
+                    'No session found with key: %s' % wssk)
+
+            entry_key = ndb.Key(WishlistEntry, wssk, parent=prof.key)
+            entry = entry_key.get()
+
+            # add, writing a new Profile in the same put_multi
+            if add:
+                # check if user already wishing for this session otherwise add
+                if entry:
+                    raise ConflictException(
+                        "You are already interested in this session")
+                ndb.put_multi([WishlistEntry(key=entry_key, session=sess.key,
+                    conference=sess.key.parent())] + ctx.takeDirty())
                 retval = True
+
+            # remove
             else:
-                retval = False
+                if entry:
+                    entry_key.delete()
+                    retval = True
+                else:
+                    retval = False
+        finally:
+            ctx.flush()
 
-        # write things back to the datastore & return
-        prof.put()
         return BooleanMessage(data=retval)
 
     @endpoints.method(SESS_WISH, BooleanMessage,
             path='session/iswishing/{websafeSessionKey}',
             http_method='POST', name='isUserWishing')
+    @instrumentation.instrumented
     def isUserWishing(self, request):
         """Add session to user's wishlist. It doesn't matter if the user is scheduled to attend the session's conference."""
         return self._isUserWishing(request)
@@ -913,6 +1397,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESS_WISH, BooleanMessage,
             path='session/addwish/{websafeSessionKey}',
             http_method='POST', name='addSessionToWishlist')
+    @instrumentation.instrumented
     def addSessionToWishlist(self, request):
         """Add session to user's wishlist. It doesn't matter if the user is scheduled to attend the session's conference."""
         return self._toggleSessionWishlist(request)
@@ -920,6 +1405,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESS_WISH, BooleanMessage,
             path='session/removewish/{websafeSessionKey}',
             http_method='POST', name='removeSessionFromWishlist')
+    @instrumentation.instrumented
     def removeSessionFromWishlist(self, request):
         """Remove session from user's wishlist."""
         return self._toggleSessionWishlist(request, False)
@@ -928,86 +1414,55 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESS_CONF_GET_REQUEST, SessionForms,
             path='sessions/wishlist',
             http_method='GET', name='getSessionsInWishlist')
+    @instrumentation.instrumented
     def getSessionsInWishlist(self, request):
         """Get list of sessions for a specific conference that user wishes to attend."""
         # TODO:
         # step 1: get user profile
-        print ("in conference.py, getSessionsInWishlist")
         prof = self._getProfileFromUser() # get user Profile
-        # step 2: get conferenceKeysToAttend from profile.
-        # to make a ndb key from websafe key you can use:
-        # ndb.Key(urlsafe=my_websafe_key_string)
-        keys_to_attend = []
-        conf_sessions = []
-        prof_sessions = []
-        for rawKey in prof.sessionKeysWishList:
-            key = ndb.Key(urlsafe=rawKey)
-            print("rawKey: {}", rawKey)
-            sess_temp = key.get()
-            print("session: {}", repr(sess_temp))
-            prof_sessions.append(sess_temp)
-        # Use get_multi(array_of_keys) to fetch all keys at once.
-        # Do not fetch them one by one!
-        # sessions = ndb.get_multi(keys_to_attend)
-        # print("about to get ndb.Key for conference")
-        # conf_key = ndb.Key(Conference, request.websafeConferenceKey)
-        # for sess in prof_sessions:
-        #     print ("session.conferenceName: {}", sess.conferenceName)
-        #     q = Conference.query()
-        #     sessionConference = q.filter(Conference.name == sess.conferenceName).get()
-        #     sessionConferenceKey = sessionConference.key
-
-        #     print ("sessionConferenceKey: {}", sessionConferenceKey)
-        #     print ("sessionConferenceKey: {}", sessionConferenceKey.urlsafe())
-        #     print ("conf_key: {}", request.websafeConferenceKey)
-        #     print ("conf_key: {}", conf_key)
-        #     if sessionConferenceKey == conf_key:
-        #         conf_sessions.add(session) 
-        print("about to return: {}", repr([self._copySessionToForm(sess) for sess in prof_sessions]))
+        # step 2: fetch one page of wishlisted sessions with get_multi; the
+        # WishlistEntry ids are the sessions' websafe keys
+        wishlist = [entry_key.id() for entry_key in
+            WishlistEntry.query(ancestor=prof.key).fetch(keys_only=True)]
+        sessions, next_token = self._fetchKeysPage(
+            [ndb.Key(urlsafe=wssk) for wssk in wishlist], request)
 
-        # return set of ConferenceForm objects per Conference
-        return SessionForms(items=[self._copySessionToForm(sess)\
-            for sess in prof_sessions])
+        # return set of SessionForm objects; all of them are wishlisted, so
+        # the wishlist needs no second lookup as in _copySessionsToForms
+        return SessionForms(
+            items=self._copySessionList(sessions, set(wishlist),
+                self._fieldMask(request.fields, SessionForm)),
+            nextPageToken=next_token)
 
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the nearly sold out set from a full query & assign the
+        announcement to memcache; used by the memcache cron job as a
+        consistency sweep, since registrations keep the set up to date.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return announcements.sweep()
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumentation.instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        # TODO 1
         # return an existing announcement from Memcache or an empty string.
-        announcement = ""
-        return StringMessage(data=announcement)
+        return StringMessage(data=announcements.getAnnouncement())
+
+
+    @endpoints.method(message_types.VoidMessage, StringMessage,
+            path='conference/featured_speaker/get',
+            http_method='GET', name='getFeaturedSpeaker')
+    @instrumentation.instrumented
+    def getFeaturedSpeaker(self, request):
+        """Return the featured speaker from memcache, or an empty string."""
+        return StringMessage(data=speakers.getFeaturedSpeaker())
 
 
 
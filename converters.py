@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Entity to ProtoRPC message converters.
+
+A Converter works out once, when it is registered, which message fields
+are copied from which model properties and how each value is converted,
+so copying an entity is a single loop over that plan instead of
+all_fields()/hasattr/getattr reflection for every entity. Message fields
+ending in 'Date' are converted with str(), as before.
+
+"""
+
+import instrumentation
+
+
+# field masks whose copy plans are kept, per Converter
+MAX_MASKED_PLANS = 64
+
+
+class Converter(object):
+    """Copy plan from one ndb model class to one ProtoRPC message class."""
+
+    def __init__(self, model, message, convert=None, exclude=()):
+        convert = convert or {}
+        self.message = message
+        self.plan = []
+        for field in message.all_fields():
+            if field.name not in model._properties or field.name in exclude:
+                continue
+            func = convert.get(field.name)
+            if func is None and field.name.endswith('Date'):
+                func = str
+            self.plan.append((field.name, func))
+        self._masked = {}
+        # none of our forms have required fields; only check those that do
+        self.checkInitialized = any(field.required
+                                    for field in message.all_fields())
+
+    def copy(self, entity, **extra):
+        """Return a message holding entity's values plus the extra fields."""
+        return self.copyAll([entity], lambda _: extra)[0]
+
+    def _maskedPlan(self, fields):
+        fields = frozenset(fields)
+        plan = self._masked.get(fields)
+        if plan is None:
+            plan = [(name, func) for name, func in self.plan if name in fields]
+            if len(self._masked) < MAX_MASKED_PLANS:
+                self._masked[fields] = plan
+        return plan
+
+    def copyAll(self, entities, extra=None, fields=None):
+        """Return one message per entity; extra, if given, is called with
+        each entity and returns a dict of additional field values. With a
+        fields mask only those fields are read and filled in, which also
+        makes it safe to copy projected entities."""
+        message = self.message
+        plan = self.plan if fields is None else self._maskedPlan(fields)
+        forms = []
+        with instrumentation.phase('serialize'):
+            for entity in entities:
+                values = {}
+                for name, func in plan:
+                    value = getattr(entity, name)
+                    if func is not None:
+                        value = func(value)
+                    if value is not None and value != []:
+                        values[name] = value
+                if extra is not None:
+                    for name, value in extra(entity).iteritems():
+                        if fields is None or name in fields:
+                            values[name] = value
+                form = message(**values)
+                if self.checkInitialized:
+                    form.check_initialized()
+                forms.append(form)
+        return forms
+
+
+_converters = {}
+
+
+def register(model, message, convert=None, exclude=()):
+    """Build & register the Converter for (model, message); return it.
+    convert maps field names to value conversions, exclude names fields
+    the caller fills in itself."""
+    converter = _converters[(model, message)] = Converter(
+        model, message, convert, exclude)
+    return converter
+
+
+def get(model, message):
+    """Return the registered Converter for (model, message)."""
+    return _converters[(model, message)]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""deletion.py
+
+Cascading conference delete.
+
+markDeleted() runs in the deleteConference transaction: it deletes the
+Conference entity and its name claim, so the conference is gone from
+every read path at once, and records a ConferenceDeletion job. A chain
+of /tasks/delete_conference tasks then removes what referred to the
+conference, one bounded batch per task, stage by stage:
+
+  * sessions -- the Session children, and their Speaker index entries;
+  * wishlist -- WishlistEntry entities for those sessions;
+  * registrations -- Registration entities;
+  * attendees, wishers -- legacy Profile.conferenceKeysToAttend &
+    sessionKeysWishList references;
+  * shards -- the SeatShards, and any SeatDrift the sweeper recorded.
+
+Every batch is a keys-only cursor query and a delete_multi (or one small
+transaction per Profile), checkpointed with jobs.runStage(), so a task
+that runs twice repeats a batch of idempotent deletes and changes
+nothing else.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import ConferenceDeletion
+from models import Profile
+from models import Registration
+from models import Session
+from models import WishlistEntry
+import jobs
+import names
+import seats
+import speakers
+import sweeper
+
+DELETE_BATCH_SIZE = 200
+STAGES = ('sessions', 'wishlist', 'registrations', 'attendees', 'wishers',
+          'shards')
+
+
+def deletionKey(conf_key):
+    """Return the ConferenceDeletion key of a conference."""
+    return ndb.Key(ConferenceDeletion, conf_key.urlsafe())
+
+
+def markDeleted(conf):
+    """Delete a Conference & its name claim and start the background
+    delete of everything else; must run inside a cross-group transaction."""
+    job = ConferenceDeletion(key=deletionKey(conf.key), name=conf.name,
+                             organizerUserId=conf.organizerUserId,
+                             seatShards=conf.seatShards, stage=STAGES[0])
+    names.releaseName(conf.name, conf.key)
+    job.put()
+    conf.key.delete()
+    taskqueue.add(params={'conference': conf.key.urlsafe()},
+                  url='/tasks/delete_conference', transactional=True)
+    return job
+
+
+def _deleteSessions(conf_key, job, cursor):
+    keys, cursor, more = Session.query(ancestor=conf_key).fetch_page(
+        DELETE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    speakers.unindexSessions([sess for sess in ndb.get_multi(keys) if sess])
+    ndb.delete_multi(keys)
+    return len(keys), cursor, more
+
+
+def _deleteChildren(model):
+    def deleteBatch(conf_key, job, cursor):
+        keys, cursor, more = model.query(model.conference == conf_key).fetch_page(
+            DELETE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+        ndb.delete_multi(keys)
+        return len(keys), cursor, more
+    return deleteBatch
+
+
+@ndb.transactional_tasklet
+def _stripReferences(p_key, conf_key):
+    """Drop a conference & its sessions from a Profile's legacy lists."""
+    prof = yield p_key.get_async()
+    if not prof:
+        return
+    wsck = conf_key.urlsafe()
+    attending = [key for key in prof.conferenceKeysToAttend if key != wsck]
+    wishes = [key for key in prof.sessionKeysWishList
+              if ndb.Key(urlsafe=key).parent() != conf_key]
+    if attending != prof.conferenceKeysToAttend or \
+            wishes != prof.sessionKeysWishList:
+        prof.conferenceKeysToAttend = attending
+        prof.sessionKeysWishList = wishes
+        yield prof.put_async()
+
+
+def _fixProfiles(query):
+    def fixBatch(conf_key, job, cursor):
+        keys, cursor, more = query(conf_key).fetch_page(
+            DELETE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+        # a failed transaction fails the batch, so the task retries it
+        for future in [_stripReferences(p_key, conf_key) for p_key in keys]:
+            future.get_result()
+        return len(keys), cursor, more
+    return fixBatch
+
+
+def _deleteShards(conf_key, job, cursor):
+    keys = seats.shardKeys(conf_key, job.seatShards)
+    ndb.delete_multi(keys + [sweeper.driftKey(conf_key)])
+    memcache.delete(seats.MEMCACHE_SEATS_KEY % conf_key.urlsafe())
+    return len(keys), None, False
+
+
+_BATCHES = {
+    'sessions': _deleteSessions,
+    'wishlist': _deleteChildren(WishlistEntry),
+    'registrations': _deleteChildren(Registration),
+    'attendees': _fixProfiles(lambda conf_key: Profile.query(
+        Profile.conferenceKeysToAttend == conf_key.urlsafe())),
+    # legacy wishlists are not queryable by conference; visit them all
+    'wishers': _fixProfiles(lambda conf_key: Profile.query(
+        Profile.sessionKeysWishList > '')),
+    'shards': _deleteShards,
+}
+
+
+def runDeletionBatch(wsck):
+    """Run the next batch of a conference's ConferenceDeletion job."""
+    conf_key = ndb.Key(urlsafe=wsck)
+    job = deletionKey(conf_key).get()
+    if not job or job.done:
+        return
+
+    def record(job, count):
+        job.removed += count
+    jobs.runStage(job, STAGES,
+                  lambda stage, cursor: _BATCHES[stage](conf_key, job, cursor),
+                  record, '/tasks/delete_conference', param='conference')
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""importer.py
+
+Bulk conference import from an uploaded CSV or NDJSON file.
+
+The upload is kept in the blobstore and streamed by a chain of
+/tasks/import_conferences tasks. Each task reads one chunk of lines from
+the byte offset checkpointed on the ImportJob, writes each row's
+conference in one transaction with its name claim and enqueues its
+successor in the same transaction as the new checkpoint, so a task cut
+off by its deadline simply runs again.
+
+CSV files need a header row naming ConferenceForm fields; topics are
+separated by ';'. NDJSON files hold one JSON object per line.
+
+"""
+
+import csv
+import json
+import time
+
+import endpoints
+from protorpc import messages
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import ImportJob
+from models import Profile
+import cache
+import jobs
+import names
+import seats
+
+IMPORT_CHUNK_ROWS = 100
+# stop reading well before the 10 minute task deadline
+IMPORT_CHUNK_SECONDS = 60
+MAX_REPORTED_ERRORS = 50
+CSV_LIST_SEPARATOR = ';'
+IMPORT_FIELDS = ('name', 'description', 'topics', 'city', 'startDate',
+                 'endDate', 'maxAttendees')
+
+
+def startImport(blob_info, user_id, email):
+    """Create an ImportJob for an uploaded file & start processing it."""
+    fmt = 'csv'
+    if blob_info.filename.lower().endswith(('.ndjson', '.jsonl', '.json')):
+        fmt = 'ndjson'
+    job = ImportJob(blobKey=blob_info.key(), format=fmt,
+                    organizerUserId=user_id, email=email)
+    job.put()
+    taskqueue.add(params={'job': job.key.id()}, url='/tasks/import_conferences')
+    return job
+
+
+def _decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def _formFromLine(fmt, header, line):
+    """Parse one line of the upload into a ConferenceForm."""
+    if fmt == 'ndjson':
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError('expected a JSON object')
+        if row.get('topics') is not None and \
+                not isinstance(row['topics'], list):
+            raise ValueError("'topics' must be a list")
+    else:
+        row = dict(zip(header, next(csv.reader([line]))))
+        if row.get('topics'):
+            row['topics'] = [topic.strip() for topic in
+                row['topics'].split(CSV_LIST_SEPARATOR) if topic.strip()]
+    form = ConferenceForm()
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        if value in (None, '', []):
+            continue
+        if field == 'maxAttendees':
+            value = int(value)
+        elif field == 'topics':
+            value = [_decode(topic) for topic in value]
+        else:
+            value = _decode(value)
+        setattr(form, field, value)
+    return form
+
+
+def runImportChunk(job_id):
+    """Import the next chunk of an ImportJob."""
+    job = ImportJob.get_by_id(job_id)
+    if not job or job.done:
+        return
+
+    start = job.offset
+    reader = blobstore.BlobReader(job.blobKey, position=start)
+    header = list(job.csvHeader)
+    errors = []
+    eof = False
+    if job.format == 'csv' and not header:
+        try:
+            header = [name.strip() for name in
+                      next(csv.reader([reader.readline()]))]
+        except csv.Error as e:
+            # without the header no row can be read; finish the job
+            errors.append('header: %s' % e)
+            eof = True
+
+    p_key = ndb.Key(Profile, job.organizerUserId)
+    deadline = time.time() + IMPORT_CHUNK_SECONDS
+    pending = []
+    rows = imported = 0
+    while not eof and rows < IMPORT_CHUNK_ROWS and time.time() < deadline:
+        line = reader.readline()
+        if not line:
+            eof = True
+            break
+        if not line.strip():
+            continue
+        rows += 1
+        row_number = job.rowsRead + rows
+        try:
+            data = ConferenceApi._conferenceDataFromForm(
+                _formFromLine(job.format, header, line))
+        except (ValueError, TypeError, csv.Error, messages.ValidationError,
+                endpoints.BadRequestException) as e:
+            errors.append('row %d: %s' % (row_number, e))
+            continue
+        # keys derived from the row make a re-run chunk overwrite, not duplicate
+        c_key = ndb.Key(Conference, 'import-%d-%d' % (job_id, row_number),
+                        parent=p_key)
+        data['key'] = c_key
+        data['organizerUserId'] = job.organizerUserId
+        shards = seats.newShards(c_key, data['seatsAvailable'])
+        data['seatShards'] = len(shards)
+        pending.append((row_number, Conference(**data), shards))
+
+    # conference names are unique: reject repeats within the chunk, then
+    # claim each name & write its conference in one transaction, with the
+    # chunk's transactions running concurrently
+    seen = set()
+    claims = []
+    for row_number, conf, shards in pending:
+        name = names.normalize(conf.name)
+        if name in seen:
+            errors.append("row %d: the name '%s' appears earlier in the file"
+                          % (row_number, conf.name))
+            continue
+        seen.add(name)
+        claims.append((row_number, conf, names.claimAndPutAsync(
+            conf.name, conf.key, [conf] + shards)))
+    for row_number, conf, claim in claims:
+        if claim.get_result():
+            imported += 1
+        else:
+            errors.append("row %d: a conference named '%s' already exists"
+                          % (row_number, conf.name))
+    if imported:
+        cache.bumpConferenceGeneration()
+
+    end = reader.tell()
+
+    def record(job):
+        job.offset = end
+        job.csvHeader = header
+        job.rowsRead += rows
+        job.imported += imported
+        job.failed += len(errors)
+        job.errors.extend(
+            errors[:max(0, MAX_REPORTED_ERRORS - len(job.errors))])
+        job.chunks += 1
+        job.done = eof
+    jobs.checkpoint(job.key, lambda job: job.offset == start, record,
+                    '/tasks/import_conferences',
+                    final_url='/tasks/import_summary')
+
+
+def sendImportSummary(job_id):
+    """Send the one summary email of a finished ImportJob."""
+    job = ImportJob.get_by_id(job_id)
+    if not job or not job.done or not job.email:
+        return
+    body = ('Your conference import has finished.\r\n\r\n'
+            'Rows read: %d\r\nConferences imported: %d\r\nRows failed: %d\r\n'
+            % (job.rowsRead, job.imported, job.failed))
+    if job.errors:
+        body += '\r\nErrors:\r\n%s\r\n' % '\r\n'.join(job.errors)
+    mail.send_mail(
+        'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id()),     # from
+        job.email,                                  # to
+        'Your conference import has finished',      # subj
+        body                                        # body
+    )
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Per-request instrumentation of the endpoint handlers.
+
+@instrumented wraps a ConferenceApi method and records, per endpoint,
+the call and error counts, a latency histogram, the time spent in each
+phase, the datastore, memcache and urlfetch RPCs it made and the caller
+identity lookups, of which there should be at most one. Phases are:
+
+  * auth -- resolving the caller, marked with phase('auth');
+  * serialize -- copying entities to messages, marked with
+    phase('serialize');
+  * fetch -- any other time with at least one RPC outstanding;
+  * other -- the rest.
+
+Counts are aggregated in the instance and added to memcache counters at
+most once per FLUSH_INTERVAL seconds. Requests slower than
+SLOW_REQUEST_MILLIS are also kept, with their phase breakdown, in a small
+ring of memcache samples. Both writes are async RPCs that the request
+never waits on, and the only ones instrumentation makes while serving.
+getStats() returns it all for the /admin/stats handler.
+
+Also home to RateLimitFilter, which keeps a noisy log line from flooding
+the request logs.
+
+"""
+
+import functools
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_STATS_KEY = "ENDPOINT_STATS:"
+MEMCACHE_SLOW_KEY = "SLOW_REQUEST:%d"
+FLUSH_INTERVAL = 10
+SLOW_REQUEST_MILLIS = 500
+MAX_SLOW_SAMPLES = 20
+# upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+RPC_SERVICES = ('datastore_v3', 'memcache', 'urlfetch')
+PHASES = ('auth', 'fetch', 'serialize', 'other')
+
+# names of the instrumented endpoints, filled in at import
+ENDPOINTS = []
+
+_current = threading.local()
+_lock = threading.Lock()
+_pending = defaultdict(int)
+_lastFlush = [time.time()]
+# each instance fills the slow sample ring from its own random slot
+_nextSlowSlot = [random.randrange(MAX_SLOW_SAMPLES)]
+_hooksInstalledOn = [None]
+
+
+class _Record(object):
+    """Timings & RPC counts of the request being served."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.phases = defaultdict(float)
+        self.phase = None
+        self.rpcs = defaultdict(int)
+        self.inflight = 0
+        self.fetchStarted = None
+        self.identityLookups = 0
+
+    def startFetch(self, now):
+        if self.inflight and self.phase is None and self.fetchStarted is None:
+            self.fetchStarted = now
+
+    def stopFetch(self, now):
+        if self.fetchStarted is not None:
+            self.phases['fetch'] += now - self.fetchStarted
+            self.fetchStarted = None
+
+
+def _preCall(service, call, request, response, rpc):
+    record = getattr(_current, 'record', None)
+    if record is None or service not in RPC_SERVICES:
+        return
+    record.rpcs[service] += 1
+    record.inflight += 1
+    record.startFetch(time.time())
+
+
+def _postCall(service, call, request, response, rpc, error):
+    # six arguments: the hook is also called for failed RPCs
+    record = getattr(_current, 'record', None)
+    if record is None or service not in RPC_SERVICES or not record.inflight:
+        return
+    record.inflight -= 1
+    if not record.inflight:
+        record.stopFetch(time.time())
+
+
+def _installHooks():
+    # the apiproxy is replaced by tests and tools; hook whichever is current
+    apiproxy = apiproxy_stub_map.apiproxy
+    if _hooksInstalledOn[0] is apiproxy:
+        return
+    apiproxy.GetPreCallHooks().Append('instrumentation', _preCall)
+    apiproxy.GetPostCallHooks().Append('instrumentation', _postCall)
+    _hooksInstalledOn[0] = apiproxy
+
+
+class phase(object):
+    """Context manager attributing the time of a block to a phase of the
+    request being served; nested phases count towards the outer one."""
+
+    def __init__(self, name):
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        record = getattr(_current, 'record', None)
+        if record is not None and record.phase is None:
+            self.record = record
+            self.started = time.time()
+            record.stopFetch(self.started)
+            record.phase = self.name
+        return self
+
+    def __exit__(self, *exc_info):
+        record = self.record
+        if record is not None:
+            now = time.time()
+            record.phases[self.name] += now - self.started
+            record.phase = None
+            record.startFetch(now)
+        return False
+
+
+def countIdentityLookup():
+    """Count a lookup of the caller's identity in the request being
+    served."""
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.identityLookups += 1
+
+
+def lastRequest():
+    """Return the record of the last request this thread finished, or
+    None; for benchmarks & tests."""
+    return getattr(_current, 'last', None)
+
+
+def instrumented(func):
+    """Decorator recording the calls of an endpoint method; put it below
+    @endpoints.method."""
+    name = func.__name__
+    ENDPOINTS.append(name)
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if getattr(_current, 'record', None) is not None:
+            # called from another endpoint; that one is being recorded
+            return func(self, request)
+        _installHooks()
+        record = _current.record = _Record(name)
+        failed = True
+        try:
+            result = func(self, request)
+            failed = False
+            return result
+        finally:
+            _current.record = None
+            _current.last = record
+            _finish(record, failed)
+    return wrapper
+
+
+def _finish(record, failed):
+    now = time.time()
+    record.stopFetch(now)
+    millis = (now - record.started) * 1000
+    phases = dict((name, int(record.phases[name] * 1000)) for name in PHASES)
+    phases['other'] = max(0, int(millis) - sum(phases.values()))
+
+    prefix = '%s.' % record.endpoint
+    bucket = len([bound for bound in LATENCY_BUCKETS if bound < millis])
+    with _lock:
+        _pending[prefix + 'count'] += 1
+        _pending[prefix + 'errors'] += int(failed)
+        _pending[prefix + 'millis'] += int(millis)
+        _pending[prefix + 'identityLookups'] += record.identityLookups
+        _pending[prefix + 'bucket.%d' % bucket] += 1
+        for name, value in phases.items():
+            _pending[prefix + 'phase.%s' % name] += value
+        for service, count in record.rpcs.items():
+            _pending[prefix + 'rpc.%s' % service] += count
+        due = now - _lastFlush[0] >= FLUSH_INTERVAL
+
+    if millis >= SLOW_REQUEST_MILLIS:
+        _sampleSlowRequest(record, millis, phases, failed)
+    if due:
+        # started, not waited on
+        flush()
+
+
+def _sampleSlowRequest(record, millis, phases, failed):
+    with _lock:
+        slot = _nextSlowSlot[0]
+        _nextSlowSlot[0] = (slot + 1) % MAX_SLOW_SAMPLES
+    sample = {
+        'endpoint': record.endpoint,
+        'at': int(record.started),
+        'millis': int(millis),
+        'failed': failed,
+        'phases': phases,
+        'rpcs': dict(record.rpcs),
+    }
+    memcache.Client().set_multi_async({MEMCACHE_SLOW_KEY % slot: sample})
+
+
+def flush():
+    """Start adding the counts aggregated in this instance to memcache;
+    return the async RPC, or None if there was nothing to add."""
+    with _lock:
+        deltas = dict(_pending)
+        _pending.clear()
+        _lastFlush[0] = time.time()
+    if not deltas:
+        return None
+    return memcache.Client().offset_multi_async(
+        deltas, key_prefix=MEMCACHE_STATS_KEY, initial_value=0)
+
+
+def _percentile(buckets, count, p):
+    """Return the upper bound of the histogram bucket holding the p-th
+    quantile, or None for the open-ended last bucket."""
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= count * p:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def getStats():
+    """Return the per endpoint aggregates & the slow request samples."""
+    rpc = flush()
+    if rpc:
+        rpc.get_result()
+    names = []
+    for endpoint in ENDPOINTS:
+        names.extend('%s.%s' % (endpoint, counter) for counter in
+            ['count', 'errors', 'millis', 'identityLookups'] +
+            ['bucket.%d' % i for i in range(len(LATENCY_BUCKETS) + 1)] +
+            ['phase.%s' % name for name in PHASES] +
+            ['rpc.%s' % service for service in RPC_SERVICES])
+    values = memcache.get_multi(names, key_prefix=MEMCACHE_STATS_KEY)
+
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        value = lambda counter: values.get('%s.%s' % (endpoint, counter), 0)
+        count = value('count')
+        if not count:
+            continue
+        buckets = [value('bucket.%d' % i)
+                   for i in range(len(LATENCY_BUCKETS) + 1)]
+        endpoints[endpoint] = {
+            'count': count,
+            'errors': value('errors'),
+            'avgMillis': value('millis') / float(count),
+            'histogram': dict(zip(
+                ['<=%d' % bound for bound in LATENCY_BUCKETS] +
+                ['>%d' % LATENCY_BUCKETS[-1]], buckets)),
+            'p50Millis': _percentile(buckets, count, 0.5),
+            'p90Millis': _percentile(buckets, count, 0.9),
+            'p99Millis': _percentile(buckets, count, 0.99),
+            'avgPhaseMillis': dict((name, value('phase.%s' % name) / float(count))
+                                   for name in PHASES),
+            'avgRpcs': dict((service, value('rpc.%s' % service) / float(count))
+                            for service in RPC_SERVICES),
+            'avgIdentityLookups': value('identityLookups') / float(count),
+        }
+    samples = memcache.get_multi([MEMCACHE_SLOW_KEY % i
+                                  for i in range(MAX_SLOW_SAMPLES)]).values()
+    return {
+        'endpoints': endpoints,
+        'slowRequests': sorted(samples, key=lambda s: s['at'], reverse=True),
+    }
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most limit records per message per window seconds;
+    the first record of the next window says how many were dropped."""
+
+    def __init__(self, limit=10, window=60, maxMessages=1000):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.window = window
+        self.maxMessages = maxMessages
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.time()
+        with self._lock:
+            started, count, dropped = self._seen.get(key, (now, 0, 0))
+            if now - started >= self.window:
+                started, count = now, 0
+            if count >= self.limit:
+                self._seen[key] = (started, count, dropped + 1)
+                return False
+            if len(self._seen) >= self.maxMessages and key not in self._seen:
+                self._seen.clear()
+            self._seen[key] = (started, count + 1, 0)
+        if dropped:
+            record.msg = '%s [%d similar messages dropped]' % (
+                record.msg, dropped)
+        return True
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""jobs.py
+
+Background jobs run as a chain of tasks, one bounded batch per task.
+
+A job entity records how far the job got. Each task runs the next batch
+and then checkpoints: in one transaction it records the batch on the job
+and enqueues the task for the next batch. A task that runs twice finds
+that the job has moved on since its batch started, and it changes
+nothing, so batches only need to be idempotent.
+
+runStage() is for jobs that work through stages of cursor queries and
+keep the stage, the websafe cursor & a batch count on the job.
+
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+
+@ndb.transactional()
+def checkpoint(job_key, isAt, record, url, param='job', final_url=None):
+    """Record a finished batch and enqueue what comes next; return the job.
+
+    isAt(job) tells whether the job is still where the batch started; if
+    not, the batch was already recorded and nothing changes. record(job)
+    adds the batch to the job and sets job.done. The next task goes to
+    url, or to final_url (if any) once the job is done."""
+    job = job_key.get()
+    if job.done or not isAt(job):
+        return job
+    record(job)
+    job.put()
+    url = final_url if job.done else url
+    if url:
+        taskqueue.add(params={param: job_key.id()}, transactional=True,
+                      url=url)
+    return job
+
+
+def runStage(job, stages, batch, record, url, param='job'):
+    """Run the next batch of a staged job and checkpoint it; return the job.
+
+    batch(stage, cursor) returns (results, next cursor, more) and
+    record(job, results) adds the results to the job. The job moves to
+    the next stage when a stage runs out, and is done after the last."""
+    stage, cursor = job.stage, job.cursor
+    results, next_cursor, more = batch(
+        stage, ndb.Cursor(urlsafe=cursor) if cursor else None)
+    if more and next_cursor:
+        next_stage, next_cursor = stage, next_cursor.urlsafe()
+    else:
+        following = stages.index(stage) + 1
+        next_stage = stages[following] if following < len(stages) else None
+        next_cursor = None
+
+    def advance(job):
+        job.stage = next_stage
+        job.cursor = next_cursor
+        job.batches += 1
+        job.done = next_stage is None
+        record(job, results)
+    return checkpoint(job.key,
+                      lambda job: job.stage == stage and job.cursor == cursor,
+                      advance, url, param)
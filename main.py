@@ -12,10 +12,30 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext.webapp import blobstore_handlers
 from conference import ConferenceApi
+from models import Profile
+from models import Session
+from utils import getUserId
+import cache
+import deletion
+import importer
+import instrumentation
+import seats
+import speakers
+import sweeper
+
+MIGRATE_PROFILES_BATCH_SIZE = 100
+INDEX_SPEAKERS_BATCH_SIZE = 200
+BACKFILL_SESSIONS_BATCH_SIZE = 200
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -24,6 +44,17 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         ConferenceApi._cacheAnnouncement()
 
 
+class SweepReferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a sweep of dangling references & seat drift."""
+        job = sweeper.startSweep()
+        self.response.write('Reference sweep %d running.' % job.key.id())
+
+    def post(self):
+        """Sweep the next page, then chain the one after."""
+        sweeper.runSweepBatch(int(self.request.get('job')))
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
@@ -38,8 +69,151 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write the sharded seat count back to the Conference."""
+        seats.syncSeatsAvailable(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+
+
+class MigrateProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving legacy Profile key lists into child entities."""
+        taskqueue.add(url='/tasks/migrate_profiles')
+        self.response.write('Profile migration started.')
+
+    def post(self):
+        """Migrate one batch of Profiles, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            MIGRATE_PROFILES_BATCH_SIZE, start_cursor=cursor)
+        for prof in profiles:
+            if prof.conferenceKeysToAttend or prof.sessionKeysWishList:
+                ConferenceApi._migrateProfile(prof.key)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/migrate_profiles')
+
+
+class IndexSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start adding existing Sessions to the Speaker index."""
+        taskqueue.add(url='/tasks/index_speakers')
+        self.response.write('Speaker indexing started.')
+
+    def post(self):
+        """Index the given Sessions, or one batch of all Sessions and
+        then chain the next batch."""
+        wssks = self.request.get_all('session')
+        if wssks:
+            sessions = ndb.get_multi([ndb.Key(urlsafe=wssk) for wssk in wssks])
+            speakers.indexSessions([sess for sess in sessions if sess])
+            return
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        sessions, next_cursor, more = Session.query().fetch_page(
+            INDEX_SPEAKERS_BATCH_SIZE, start_cursor=cursor)
+        speakers.indexSessions(sessions)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/index_speakers')
+
+
+class BackfillSessionsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start rewriting Sessions to fill in their computed fields."""
+        taskqueue.add(url='/tasks/backfill_sessions')
+        self.response.write('Session backfill started.')
+
+    def post(self):
+        """Rewrite one batch of Sessions, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        sessions, next_cursor, more = Session.query().fetch_page(
+            BACKFILL_SESSIONS_BATCH_SIZE, start_cursor=cursor)
+        # putting a Session recomputes sessionType, startHour &
+        # startsBeforeHour
+        ndb.put_multi(sessions)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/backfill_sessions')
+
+
+class DeleteConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run the next batch of a cascading conference delete."""
+        deletion.runDeletionBatch(self.request.get('conference'))
+
+
+class ImportConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the conference import upload form."""
+        self.response.write(
+            '<form action="%s" method="POST" enctype="multipart/form-data">'
+            'CSV or NDJSON file: <input type="file" name="file"> '
+            '<input type="submit" value="Import"></form>' %
+            blobstore.create_upload_url('/admin/import_conferences/upload'))
+
+
+class ImportUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
+    def post(self):
+        """Start importing an uploaded conference file."""
+        uploads = self.get_uploads('file')
+        if not uploads:
+            self.abort(400, 'No file uploaded.')
+        user = users.get_current_user()
+        job = importer.startImport(uploads[0], getUserId(user), user.email())
+        self.response.write('Import %d started; a summary will be emailed '
+                            'to %s.' % (job.key.id(), user.email()))
+
+
+class ImportConferencesTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import the next chunk of an upload."""
+        importer.runImportChunk(int(self.request.get('job')))
+
+
+class ImportSummaryHandler(webapp2.RequestHandler):
+    def post(self):
+        """Email the summary of a finished import."""
+        importer.sendImportSummary(int(self.request.get('job')))
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the cache counters & per query shape statistics as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'conference': cache.getCounters(cache.CONFERENCE_COUNTERS),
+            'queries': cache.getQueryStats(),
+        }, sort_keys=True))
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the per endpoint counts, latency histograms, phase
+        timings & RPC fan-out, and the slow request samples, as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.getStats(),
+                                       sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/sweep_references', SweepReferencesHandler),
+    ('/tasks/sweep_references', SweepReferencesHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/sync_seats_available', SyncSeatsAvailableHandler),
+    ('/tasks/migrate_profiles', MigrateProfilesHandler),
+    ('/tasks/index_speakers', IndexSpeakersHandler),
+    ('/tasks/backfill_sessions', BackfillSessionsHandler),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/tasks/import_conferences', ImportConferencesTaskHandler),
+    ('/tasks/import_summary', ImportSummaryHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/stats', StatsHandler),
+    ('/admin/import_conferences', ImportConferencesHandler),
+    ('/admin/import_conferences/upload', ImportUploadHandler),
 ], debug=True)
 
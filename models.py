@@ -30,6 +30,74 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats"""
+    seats           = ndb.IntegerProperty(default=0, indexed=False)
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- singleton set of nearly sold out conferences,
+    maintained as registrations cross the announcement threshold"""
+    conferences     = ndb.JsonProperty(default={})   # websafe key -> name
+
+class ConferenceName(ndb.Model):
+    """ConferenceName -- uniqueness index of conference names, keyed by
+    the normalized name"""
+    conference      = ndb.KeyProperty(kind='Conference', required=True)
+
+class Speaker(ndb.Model):
+    """Speaker -- index of the Sessions given by a speaker, keyed by the
+    normalized speaker name"""
+    name            = ndb.StringProperty(indexed=False)
+    sessions        = ndb.KeyProperty(kind='Session', repeated=True, indexed=False)
+
+class ImportJob(ndb.Model):
+    """ImportJob -- progress of a bulk conference import from an upload"""
+    blobKey         = ndb.BlobKeyProperty(required=True)
+    format          = ndb.StringProperty(choices=('csv', 'ndjson'))
+    organizerUserId = ndb.StringProperty()
+    email           = ndb.StringProperty()
+    csvHeader       = ndb.StringProperty(repeated=True, indexed=False)
+    offset          = ndb.IntegerProperty(default=0, indexed=False)
+    rowsRead        = ndb.IntegerProperty(default=0, indexed=False)
+    imported        = ndb.IntegerProperty(default=0, indexed=False)
+    failed          = ndb.IntegerProperty(default=0, indexed=False)
+    errors          = ndb.StringProperty(repeated=True, indexed=False)
+    chunks          = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class ConferenceDeletion(ndb.Model):
+    """ConferenceDeletion -- progress of the background delete of a
+    Conference's dependents; keyed by the conference's websafe key"""
+    name            = ndb.StringProperty(indexed=False)
+    organizerUserId = ndb.StringProperty()
+    seatShards      = ndb.IntegerProperty(default=0, indexed=False)
+    stage           = ndb.StringProperty(indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    removed         = ndb.IntegerProperty(default=0, indexed=False)
+    batches         = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class SeatDrift(ndb.Model):
+    """SeatDrift -- seat count discrepancy seen by a reference sweep, which
+    is only repaired if the next sweep sees it again; keyed by the
+    conference's websafe key"""
+    drift           = ndb.IntegerProperty(indexed=False)
+    seen            = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class SweepJob(ndb.Model):
+    """SweepJob -- progress & report of a reference consistency sweep"""
+    stage           = ndb.StringProperty(indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    scanned         = ndb.IntegerProperty(default=0, indexed=False)
+    changed         = ndb.IntegerProperty(default=0, indexed=False)
+    changes         = ndb.StringProperty(repeated=True, indexed=False)
+    batches         = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -49,6 +117,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
@@ -59,6 +128,9 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)     # ConferenceForm field names
 
 # replace your existing Profile class with this
 class Profile(ndb.Model):
@@ -66,9 +138,22 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy lists of websafe keys; moved into Registration and
+    # WishlistEntry children by ConferenceApi._migrateProfile
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysWishList = ndb.StringProperty(repeated=True)
 
+class Registration(ndb.Model):
+    """Registration -- Profile's registration for a Conference;
+    child of the Profile, keyed by the conference's websafe key"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- Session in a Profile's wishlist;
+    child of the Profile, keyed by the session's websafe key"""
+    session    = ndb.KeyProperty(kind='Session', required=True)
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+
 # needed for conference registration
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -97,6 +182,18 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
     sessionKeysWishList = messages.StringField(5, repeated=True)
 
+# normalized values of Session.sessionType; anything else is 'other'
+SESSION_TYPES = ('keynote', 'lecture', 'seminar', 'workshop', 'other')
+
+def _sessionType(sess):
+    sessionType = (sess.typeOfSession or '').strip().lower()
+    return sessionType if sessionType in SESSION_TYPES else 'other'
+
+def _startHour(sess):
+    if sess.startdatetime and sess.hasStartTime:
+        return sess.startdatetime.hour
+    return None
+
 class Session(ndb.Model):
     """Session -- Session Object"""
     name            = ndb.StringProperty(required=True)
@@ -104,9 +201,17 @@ class Session(ndb.Model):
     speaker         = ndb.StringProperty()
     typeOfSession   = ndb.StringProperty()
     location        = ndb.StringProperty()
-    startdatetime   = ndb.DateProperty()
+    startdatetime   = ndb.DateTimeProperty()
+    hasStartTime    = ndb.BooleanProperty(default=False, indexed=False)
     duration        = ndb.IntegerProperty()    
     conferenceName  = ndb.StringProperty(required=True)
+    # derived, for time-of-day queries made only of equality/IN filters
+    sessionType     = ndb.ComputedProperty(_sessionType)
+    startHour       = ndb.ComputedProperty(_startHour)
+    # every hour H for which "starts before H:00" holds
+    startsBeforeHour = ndb.ComputedProperty(lambda sess:
+        [] if _startHour(sess) is None else range(_startHour(sess) + 1, 25),
+        repeated=True)
 
 class SessionForm(messages.Message):
     """SessionForm -- """
@@ -125,6 +230,16 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class SessionCreateResult(messages.Message):
+    """SessionCreateResult -- outcome of one item of a bulk session create"""
+    websafeKey      = messages.StringField(1)
+    error           = messages.StringField(2)
+
+class SessionCreateResults(messages.Message):
+    """SessionCreateResults -- per-item outcomes, in request order"""
+    items = messages.MessageField(SessionCreateResult, 1, repeated=True)
 
 class SessionQueryForm(messages.Message):
     """SessionQueryForm -- Session query inbound form message"""
@@ -136,6 +251,9 @@ class SessionQueryForms(messages.Message):
     """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
     # websafeConferenceKey=messages.StringField(1)
     filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)     # SessionForm field names
 
 
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""names.py
+
+Conference name to key index.
+
+Each conference name is claimed by a ConferenceName entity keyed by the
+normalized name, which makes names unique and turns "which conference
+is called X" into a key get; memcache fronts the lookups. Conferences
+created before the index existed are claimed the first time they are
+looked up by name.
+
+"""
+
+import endpoints
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceName
+from models import ConflictException
+
+MEMCACHE_NAME_KEY = "CONFERENCE_NAME:%s"
+NAME_CACHE_TIMEOUT = 3600
+
+
+def normalize(name):
+    """Return the form of a conference name that must be unique."""
+    return u' '.join(name.split()).lower()
+
+
+def nameKey(name):
+    """Return the ConferenceName key of a conference name."""
+    return ndb.Key(ConferenceName, normalize(name))
+
+
+def _cacheKey(name):
+    return MEMCACHE_NAME_KEY % normalize(name).encode('utf-8')
+
+
+@ndb.transactional_tasklet(xg=True)
+def claimNameAsync(name, conf_key):
+    """Claim a name for a conference; the future's result is False if
+    another existing conference holds it. Joins the caller's transaction,
+    if any; a new conference must be written in that same transaction
+    (see claimAndPutAsync), or a concurrent claim could take the name
+    over before the conference exists."""
+    entry = yield nameKey(name).get_async()
+    if entry and entry.conference != conf_key:
+        holder = yield entry.conference.get_async()
+        if holder:
+            raise ndb.Return(False)
+    if not entry or entry.conference != conf_key:
+        yield ConferenceName(key=nameKey(name), conference=conf_key).put_async()
+    ndb.get_context().call_on_commit(lambda: memcache.set(
+        _cacheKey(name), conf_key.urlsafe(), time=NAME_CACHE_TIMEOUT))
+    raise ndb.Return(True)
+
+
+@ndb.transactional_tasklet(xg=True)
+def claimAndPutAsync(name, conf_key, entities):
+    """Claim a name for a new conference and write the conference's
+    entities in the same transaction, so a claim is never seen without
+    its conference; the future's result is False, and nothing is written,
+    if another conference holds the name."""
+    claimed = yield claimNameAsync(name, conf_key)
+    if claimed:
+        yield ndb.put_multi_async(entities)
+    raise ndb.Return(claimed)
+
+
+def claimName(name, conf_key):
+    """Claim a name for a conference; raise ConflictException if another
+    conference holds it."""
+    if not claimNameAsync(name, conf_key).get_result():
+        raise ConflictException(
+            "A conference named '%s' already exists." % name)
+
+
+@ndb.transactional(xg=True)
+def releaseName(name, conf_key):
+    """Give up a conference's claim on a name."""
+    entry = nameKey(name).get()
+    if entry and entry.conference == conf_key:
+        entry.key.delete()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(_cacheKey(name)))
+
+
+def lookupName(name):
+    """Return the key of the conference with the given name, or None."""
+    wsck = memcache.get(_cacheKey(name))
+    if wsck:
+        return ndb.Key(urlsafe=wsck)
+    entry = nameKey(name).get()
+    if entry:
+        memcache.set(_cacheKey(name), entry.conference.urlsafe(),
+            time=NAME_CACHE_TIMEOUT)
+        return entry.conference
+    # a conference from before the index; claim the name if unambiguous
+    keys = Conference.query(Conference.name == name).fetch(2, keys_only=True)
+    if len(keys) > 1:
+        raise endpoints.BadRequestException(
+            "More than one conference is named '%s'; "
+            "use websafeConferenceKey." % name)
+    if not keys or not claimNameAsync(name, keys[0]).get_result():
+        return None
+    return keys[0]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""planner.py
+
+Query planner for conference filters.
+
+Rather than needing one composite index per combination of filters, a
+query runs on a small fixed set of (field, name) indexes:
+
+  * the most selective equality filters (at most MAX_ZIGZAG_FILTERS) are
+    given to the datastore, which merges their indexes with a zigzag join
+    while still returning results in name order;
+  * with no equality filter, the inequality filter is given to the
+    datastore on its own;
+  * everything else, "!=" included, is checked in memory as results
+    stream in.
+
+A listing that asks only for PROJECTION fields (plus the key-derived
+websafeKey & organizerDisplayName) and leaves the datastore no filter to
+run is served by a projection query on the one (name, city, maxAttendees,
+month, seatsAvailable) index. These properties are set on every
+Conference; an entity missing a projected property would be left out.
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from models import Conference
+
+# lower is more selective; used to choose which equality filters to push down
+SELECTIVITY = {
+    'city': 1,
+    'topics': 2,
+    'month': 3,
+    'maxAttendees': 4,
+}
+MAX_ZIGZAG_FILTERS = 2
+
+PROJECTION = ('name', 'city', 'maxAttendees', 'month', 'seatsAvailable')
+KEY_FIELDS = ('websafeKey', 'organizerDisplayName')
+
+_COMPARE = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+
+def planConferenceQuery(filters, fields=None):
+    """Return (query, residual filters, projection) for filters formatted
+    by ConferenceApi._formatFilters and an optional field mask; the
+    residual filters must be applied with matches() to the query's
+    results, which are fetched with the projection unless it is None."""
+    equalities = sorted([f for f in filters if f["operator"] == "="],
+                        key=lambda f: SELECTIVITY.get(f["field"], len(SELECTIVITY)))
+    inequalities = [f for f in filters if f["operator"] != "="]
+
+    q = Conference.query()
+    if equalities:
+        pushed = equalities[:MAX_ZIGZAG_FILTERS]
+    elif inequalities and not [f for f in inequalities if f["operator"] == "!="]:
+        pushed = inequalities
+        # an inequality filter must be the first sort order
+        q = q.order(ndb.GenericProperty(pushed[0]["field"]))
+    else:
+        pushed = []
+    # finish with the key order so pages have stable cursors
+    q = q.order(Conference.name, Conference.key)
+
+    for filtr in pushed:
+        q = q.filter(ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"]))
+    residual = [f for f in filters if f not in pushed]
+
+    projection = None
+    if fields and not pushed and \
+            set(fields) <= set(PROJECTION + KEY_FIELDS) and \
+            set(f["field"] for f in residual) <= set(PROJECTION):
+        projection = PROJECTION
+    return q, residual, projection
+
+
+def matches(entity, filters):
+    """Return True if entity passes every filter, with datastore
+    semantics: a missing value never matches and a repeated property
+    matches if any of its values does."""
+    for filtr in filters:
+        value = getattr(entity, filtr["field"], None)
+        values = value if isinstance(value, list) else [value]
+        compare = _COMPARE[filtr["operator"]]
+        if not any(v is not None and compare(v, filtr["value"]) for v in values):
+            return False
+    return True
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counter for conference registration.
+
+A conference's available seats are spread over several SeatShard root
+entities so that concurrent registrations commit against different
+entity groups instead of all contending for the single Conference
+entity. Conference.seatsAvailable is kept as a derived value, written
+back by the /tasks/sync_seats_available task.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+import cache
+
+NUM_SEAT_SHARDS = 20
+MEMCACHE_SEATS_KEY = "SEATS_AVAILABLE:%s"
+MEMCACHE_SEATS_TIMEOUT = 60
+SYNC_SEATS_INTERVAL = 10
+
+
+def shardKeys(conf_key, num_shards):
+    """Return the SeatShard keys of a conference.
+
+    Shards are root entities (not children of the conference) so that
+    each one is its own entity group.
+    """
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i)) for i in range(num_shards)]
+
+
+def newShards(conf_key, seats_available, num_shards=None):
+    """Return unsaved SeatShards splitting seats_available evenly.
+
+    A conference always gets NUM_SEAT_SHARDS shards, even with few or no
+    seats yet, so that seats added later are spread out as well.
+    """
+    if num_shards is None:
+        num_shards = NUM_SEAT_SHARDS
+    base, extra = divmod(max(0, seats_available), num_shards)
+    return [SeatShard(key=key, seats=base + (1 if i < extra else 0))
+            for i, key in enumerate(shardKeys(conf_key, num_shards))]
+
+
+@ndb.transactional(xg=True)
+def _createShards(conf_key):
+    conf = conf_key.get()
+    if conf.seatShards:
+        return conf
+    shards = newShards(conf.key, conf.seatsAvailable or 0)
+    conf.seatShards = len(shards)
+    ndb.put_multi([conf] + shards)
+    return conf
+
+
+def ensureShards(conf):
+    """Split the seats of a conference created before seat sharding
+    into shards; return the (possibly updated) conference."""
+    if conf.seatShards:
+        return conf
+    return _createShards(conf.key)
+
+
+def shardsWithSeats(conf):
+    """Return keys of the shards that still have seats, in random order."""
+    shards = ndb.get_multi(shardKeys(conf.key, conf.seatShards))
+    total = sum(shard.seats for shard in shards if shard)
+    memcache.set(MEMCACHE_SEATS_KEY % conf.key.urlsafe(), total,
+        time=MEMCACHE_SEATS_TIMEOUT)
+    keys = [shard.key for shard in shards if shard and shard.seats > 0]
+    random.shuffle(keys)
+    return keys
+
+
+def randomShard(conf):
+    """Return the key of a randomly chosen shard."""
+    return random.choice(shardKeys(conf.key, conf.seatShards))
+
+
+def takeSeat(shard_key):
+    """Take one seat from a shard; return the modified shard, or None if
+    the shard is empty. Must run inside the caller's transaction, which
+    is responsible for putting the shard."""
+    shard = shard_key.get()
+    if not shard or shard.seats <= 0:
+        return None
+    shard.seats -= 1
+    return shard
+
+
+def returnSeat(shard_key):
+    """Give one seat back to a shard; return the modified shard. Must run
+    inside the caller's transaction."""
+    shard = shard_key.get() or SeatShard(key=shard_key)
+    shard.seats += 1
+    return shard
+
+
+def adjustSeats(conf, delta):
+    """Add (or remove, if negative) seats across the shards of a
+    conference and return the new total. Must run inside a cross-group
+    transaction; the cached aggregate is dropped once it commits."""
+    keys = shardKeys(conf.key, conf.seatShards)
+    shards = [shard or SeatShard(key=key)
+              for shard, key in zip(ndb.get_multi(keys), keys)]
+    if delta > 0:
+        base, extra = divmod(delta, len(shards))
+        for i, shard in enumerate(random.sample(shards, len(shards))):
+            shard.seats += base + (1 if i < extra else 0)
+    else:
+        for shard in shards:
+            taken = min(shard.seats, -delta)
+            shard.seats -= taken
+            delta += taken
+    ndb.put_multi(shards)
+    cache_key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(cache_key))
+    return sum(shard.seats for shard in shards)
+
+
+@ndb.tasklet
+def getSeatsAvailableAsync(conf):
+    """Return a future for the aggregated seat count, served from memcache
+    when possible."""
+    if not conf.seatShards:
+        raise ndb.Return(conf.seatsAvailable)
+    ctx = ndb.get_context()
+    key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+    total = yield ctx.memcache_get(key)
+    if total is None:
+        shards = yield ndb.get_multi_async(shardKeys(conf.key, conf.seatShards))
+        total = sum(shard.seats for shard in shards if shard)
+        yield ctx.memcache_set(key, total, time=MEMCACHE_SEATS_TIMEOUT)
+    raise ndb.Return(total)
+
+
+def getSeatsAvailable(conf):
+    """Return the aggregated seat count, served from memcache when
+    possible."""
+    return getSeatsAvailableAsync(conf).get_result()
+
+
+def seatsChanged(conf_key, delta):
+    """Record a committed seat change: update the cached aggregate and
+    schedule the write-back of Conference.seatsAvailable, coalescing
+    changes into at most one task per SYNC_SEATS_INTERVAL seconds.
+    Returns the new cached aggregate, or None if it wasn't cached."""
+    wsck = conf_key.urlsafe()
+    if delta < 0:
+        total = memcache.decr(MEMCACHE_SEATS_KEY % wsck, -delta)
+    else:
+        total = memcache.incr(MEMCACHE_SEATS_KEY % wsck, delta)
+    window = int(time.time()) // SYNC_SEATS_INTERVAL
+    try:
+        taskqueue.add(params={'websafeConferenceKey': wsck},
+            url='/tasks/sync_seats_available',
+            name='sync-seats-%s-%d' % (wsck, window),
+            countdown=SYNC_SEATS_INTERVAL
+        )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    return total
+
+
+@ndb.transactional()
+def _setSeatsAvailable(conf_key, total):
+    conf = conf_key.get()
+    if conf and conf.seatsAvailable != total:
+        conf.seatsAvailable = total
+        conf.put()
+    return conf
+
+
+def syncSeatsAvailable(conf_key):
+    """Write the sum of the shards back to Conference.seatsAvailable."""
+    conf = conf_key.get()
+    if not conf or not conf.seatShards:
+        return conf
+    shards = ndb.get_multi(shardKeys(conf_key, conf.seatShards))
+    total = sum(shard.seats for shard in shards if shard)
+    memcache.set(MEMCACHE_SEATS_KEY % conf_key.urlsafe(), total,
+        time=MEMCACHE_SEATS_TIMEOUT)
+    if conf.seatsAvailable == total:
+        return conf
+    conf = _setSeatsAvailable(conf_key, total)
+    cache.bumpConferenceGeneration()
+    return conf
@@ -16,3 +16,12 @@ WEB_CLIENT_ID = '546127143230-aocegclpvbnp438fljbnnjo9672nl73o.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Token verification for utils.getUserId(id_type="oauth"). TOKENINFO_URL can
+# be pointed at a local fake tokeninfo server for testing; set
+# VERIFY_ID_TOKENS_LOCALLY to check ID token signatures against Google's
+# cached public keys instead of calling tokeninfo.
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+VERIFY_ID_TOKENS_LOCALLY = False
+TOKEN_CACHE_MAX_TTL = 3600
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Speaker index and the featured speaker.
+
+Each Speaker entity, keyed by the normalized speaker name, lists the keys
+of that speaker's sessions across all conferences, so a speaker's
+sessions are one get plus one get_multi rather than a query. The index
+is updated as sessions are created and deleted; /tasks/index_speakers
+adds the sessions written before it existed, and those whose index
+update lost to contention.
+
+A speaker who gets a second session in a conference becomes the featured
+speaker, kept in memcache.
+
+"""
+
+from collections import defaultdict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Speaker
+from names import normalize
+
+MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+
+
+def speakerKey(name):
+    """Return the Speaker key of a speaker name."""
+    return ndb.Key(Speaker, normalize(name))
+
+
+@ndb.transactional_tasklet()
+def _addSessions(name, s_keys):
+    speaker = yield speakerKey(name).get_async()
+    if not speaker:
+        speaker = Speaker(key=speakerKey(name), name=name)
+    new_keys = [s_key for s_key in s_keys if s_key not in speaker.sessions]
+    if new_keys:
+        speaker.sessions.extend(new_keys)
+        yield speaker.put_async()
+    raise ndb.Return(speaker)
+
+
+@ndb.transactional_tasklet()
+def _removeSessions(name, s_keys):
+    speaker = yield speakerKey(name).get_async()
+    if not speaker:
+        return
+    remaining = [s_key for s_key in speaker.sessions if s_key not in s_keys]
+    if not remaining:
+        yield speaker.key.delete_async()
+    elif len(remaining) != len(speaker.sessions):
+        speaker.sessions = remaining
+        yield speaker.put_async()
+
+
+def _bySpeaker(sessions):
+    """Group Sessions by normalized speaker name."""
+    groups = defaultdict(list)
+    for sess in sessions:
+        if sess.speaker and sess.speaker.strip():
+            groups[normalize(sess.speaker)].append(sess)
+    return groups
+
+
+@ndb.tasklet
+def indexSessionsAsync(sessions):
+    """Add saved Sessions to their speakers' indexes, one transaction per
+    speaker, all in flight at once; then update the featured speaker."""
+    groups = _bySpeaker(sessions)
+    speakers = yield [_addSessions(group[0].speaker,
+                                   set(sess.key for sess in group))
+                      for group in groups.values()]
+    for speaker, group in zip(speakers, groups.values()):
+        yield _checkFeatured(speaker, group[0].key.parent())
+
+
+def indexSessions(sessions):
+    """Add saved Sessions to their speakers' indexes."""
+    indexSessionsAsync(sessions).get_result()
+
+
+def unindexSessions(sessions):
+    """Remove Sessions that are being deleted from their speakers'
+    indexes."""
+    futures = [_removeSessions(group[0].speaker, set(sess.key for sess in group))
+               for group in _bySpeaker(sessions).values()]
+    for future in futures:
+        future.get_result()
+
+
+@ndb.tasklet
+def getSessionKeysAsync(name):
+    """Return a future for the keys of a speaker's sessions, oldest first."""
+    speaker = yield speakerKey(name).get_async()
+    raise ndb.Return(speaker.sessions if speaker else [])
+
+
+@ndb.tasklet
+def _checkFeatured(speaker, conf_key):
+    """Feature a speaker who has more than one session in a conference."""
+    s_keys = [s_key for s_key in speaker.sessions if s_key.parent() == conf_key]
+    if len(s_keys) < 2:
+        return
+    sessions = yield ndb.get_multi_async(s_keys)
+    yield ndb.get_context().memcache_set(MEMCACHE_FEATURED_SPEAKER_KEY,
+        '%s %s' % ('Featured speaker: %s. Sessions:' % speaker.name,
+                   ', '.join(sess.name for sess in sessions if sess)))
+
+
+def getFeaturedSpeaker():
+    """Return the featured speaker announcement, or an empty string."""
+    return memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or ""
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""sweeper.py
+
+Consistency sweep of the references to conferences & sessions.
+
+A cron starts a SweepJob, which a chain of /tasks/sweep_references tasks
+works through one cursor page per task, stage by stage:
+
+  * profiles -- legacy Profile.conferenceKeysToAttend/sessionKeysWishList
+    strings whose conference or session no longer exists are removed;
+  * registrations, wishlist -- Registration & WishlistEntry children
+    pointing at a missing conference or session are deleted;
+  * seats -- each conference's free seats are compared with
+    maxAttendees less its registrations, and the seat shards corrected
+    if they drifted.
+
+Registrations are counted with global queries, whose indexes can lag
+a registration that just committed (or a Profile in mid-migration), so
+a discrepancy is only recorded as a SeatDrift the first time it is seen
+and repaired if the next sweep finds the very same one.
+
+Every page checks its references with one get_multi and is checkpointed
+with jobs.runStage(), so each task stays well within the task deadline
+and a retried task repeats only its own idempotent page. Counts & the first changes are
+recorded on the SweepJob and logged when the sweep finishes.
+
+"""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Registration
+from models import SeatDrift
+from models import SweepJob
+from models import WishlistEntry
+import cache
+import jobs
+import seats
+
+SWEEP_BATCH_SIZE = 100
+SWEEP_SEATS_BATCH_SIZE = 20
+MAX_REPORTED_CHANGES = 100
+# a sweep that has not finished by then is presumed stuck; start afresh
+SWEEP_STALE_HOURS = 6
+STAGES = ('profiles', 'registrations', 'wishlist', 'seats')
+
+log = logging.getLogger(__name__)
+
+
+def startSweep():
+    """Start a sweep unless one is already running; return its SweepJob."""
+    since = datetime.datetime.now() - datetime.timedelta(hours=SWEEP_STALE_HOURS)
+    for job in SweepJob.query(SweepJob.done == False):
+        if job.created > since:
+            return job
+    job = SweepJob(stage=STAGES[0])
+    job.put()
+    taskqueue.add(params={'job': job.key.id()}, url='/tasks/sweep_references')
+    return job
+
+
+def _toKey(urlsafe):
+    """Return the key in a websafe string, or None if it is malformed."""
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except Exception:
+        # bad base64 or protocol buffer; either way nothing it points at
+        return None
+
+
+def _missing(keys):
+    """Return the subset of keys whose entities don't exist."""
+    keys = list(set(key for key in keys if key))
+    return set(key for key, entity in zip(keys, ndb.get_multi(keys))
+               if entity is None)
+
+
+@ndb.transactional_tasklet
+def _pruneProfile(p_key, dead):
+    """Remove the dead websafe keys from a Profile's legacy lists."""
+    prof = yield p_key.get_async()
+    if not prof:
+        return
+    prof.conferenceKeysToAttend = [wsck for wsck in
+        prof.conferenceKeysToAttend if wsck not in dead]
+    prof.sessionKeysWishList = [wssk for wssk in
+        prof.sessionKeysWishList if wssk not in dead]
+    yield prof.put_async()
+
+
+def _sweepProfiles(cursor):
+    profiles, cursor, more = Profile.query().fetch_page(
+        SWEEP_BATCH_SIZE, start_cursor=cursor)
+    strings = set()
+    for prof in profiles:
+        strings.update(prof.conferenceKeysToAttend)
+        strings.update(prof.sessionKeysWishList)
+    keys = dict((urlsafe, _toKey(urlsafe)) for urlsafe in strings)
+    missing = _missing(keys.values())
+    dead = set(urlsafe for urlsafe, key in keys.items()
+               if key is None or key in missing)
+
+    changes = []
+    futures = []
+    for prof in profiles:
+        pruned = [urlsafe for urlsafe in
+                  prof.conferenceKeysToAttend + prof.sessionKeysWishList
+                  if urlsafe in dead]
+        if pruned:
+            futures.append(_pruneProfile(prof.key, dead))
+            changes.append('profile %s: removed %d dead references'
+                           % (prof.key.id(), len(pruned)))
+    for future in futures:
+        future.get_result()
+    return (len(profiles), changes), cursor, more
+
+
+def _sweepChildren(model, target):
+    def sweepBatch(cursor):
+        # the children are keyed by their target's websafe key
+        keys, cursor, more = model.query().fetch_page(
+            SWEEP_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+        targets = dict((key, _toKey(key.id())) for key in keys)
+        missing = _missing(targets.values())
+        dead = [key for key in keys
+                if targets[key] is None or targets[key] in missing]
+        ndb.delete_multi(dead)
+        changes = ['%s of profile %s: %s %s no longer exists' % (
+                       model.__name__, key.parent().id(), target, key.id())
+                   for key in dead]
+        return (len(keys), changes), cursor, more
+    return sweepBatch
+
+
+def driftKey(conf_key):
+    """Return the SeatDrift key of a conference."""
+    return ndb.Key(SeatDrift, conf_key.urlsafe())
+
+
+@ndb.tasklet
+def _countSeatsAsync(conf):
+    """Return (free seats, seats taken) of a conference, or None if a
+    registration changed the shards while they were being counted."""
+    keys = seats.shardKeys(conf.key, conf.seatShards)
+    before, registered, legacy = yield (
+        ndb.get_multi_async(keys),
+        Registration.query(Registration.conference == conf.key).count_async(
+            limit=None),
+        Profile.query(Profile.conferenceKeysToAttend == conf.key.urlsafe()
+                      ).count_async(limit=None))
+    after = yield ndb.get_multi_async(keys)
+    free = sum(shard.seats for shard in before if shard)
+    if free != sum(shard.seats for shard in after if shard):
+        raise ndb.Return(None)
+    raise ndb.Return((free, registered + legacy))
+
+
+@ndb.transactional(xg=True)
+def _repairSeats(conf_key, free, expected):
+    """Set a conference's free seats to expected, unless they are no
+    longer free; return True if they were changed."""
+    conf = conf_key.get()
+    if not conf:
+        # deleted since it was counted
+        return False
+    shards = ndb.get_multi(seats.shardKeys(conf_key, conf.seatShards))
+    if sum(shard.seats for shard in shards if shard) != free:
+        return False
+    seats.adjustSeats(conf, expected - free)
+    return True
+
+
+def _sweepSeats(cursor):
+    conferences, cursor, more = Conference.query().fetch_page(
+        SWEEP_SEATS_BATCH_SIZE, start_cursor=cursor)
+    conferences = [seats.ensureShards(conf) for conf in conferences]
+    counts = [_countSeatsAsync(conf) for conf in conferences]
+    drifts = ndb.get_multi([driftKey(conf.key) for conf in conferences])
+    changes = []
+    seen = []
+    resolved = []
+    for conf, count, drift in zip(conferences, counts, drifts):
+        count = count.get_result()
+        if count is None:
+            continue
+        free, taken = count
+        expected = max(0, (conf.maxAttendees or 0) - taken)
+        if free == expected:
+            if drift:
+                resolved.append(drift.key)
+            continue
+        # repair only a discrepancy the previous sweep saw too
+        if not drift or drift.drift != free - expected:
+            seen.append(SeatDrift(key=driftKey(conf.key), drift=free - expected))
+            continue
+        if not _repairSeats(conf.key, free, expected):
+            continue
+        resolved.append(drift.key)
+        seats.syncSeatsAvailable(conf.key)
+        cache.invalidateConferenceForm(conf.key.urlsafe())
+        changes.append('conference %s: %d free seats -> %d (%d registered)'
+                       % (conf.key.urlsafe(), free, expected, taken))
+    ndb.put_multi(seen)
+    ndb.delete_multi(resolved)
+    return (len(conferences), changes), cursor, more
+
+
+_BATCHES = {
+    'profiles': _sweepProfiles,
+    'registrations': _sweepChildren(Registration, 'conference'),
+    'wishlist': _sweepChildren(WishlistEntry, 'session'),
+    'seats': _sweepSeats,
+}
+
+
+def runSweepBatch(job_id):
+    """Sweep the next page of a SweepJob."""
+    job = SweepJob.get_by_id(job_id)
+    if not job or job.done:
+        return
+
+    def record(job, results):
+        scanned, changes = results
+        job.scanned += scanned
+        job.changed += len(changes)
+        job.changes.extend(
+            changes[:max(0, MAX_REPORTED_CHANGES - len(job.changes))])
+    job = jobs.runStage(job, STAGES,
+                        lambda stage, cursor: _BATCHES[stage](cursor),
+                        record, '/tasks/sweep_references')
+    if job.done:
+        log.info('Reference sweep %d finished: %d entities scanned, '
+                 '%d changed; %s', job.key.id(), job.scanned, job.changed,
+                 '; '.join(job.changes) or 'nothing to repair')
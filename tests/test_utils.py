@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""test_utils.py
+
+Tests of the bearer token verification behind getUserId(id_type="oauth"),
+run on testbed stubs against a local fake tokeninfo & certs server.
+
+    GAE_SDK=/path/to/google_appengine python -m unittest discover tests
+
+"""
+
+import BaseHTTPServer
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+import urlparse
+from collections import defaultdict
+
+# the benchmarks' SDK bootstrap finds the SDK & puts the app on sys.path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import sdk
+sdk.setup()
+
+from google.appengine.api import memcache
+
+import settings
+import utils
+
+
+class FakeGoogle(BaseHTTPServer.HTTPServer):
+    """Serves /tokeninfo for the tokens in self.tokens (token -> seconds
+    to expiry) & /certs for self.jwks, counting requests per token."""
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0), _Handler)
+        self.tokens = {}
+        self.jwks = []
+        self.hits = defaultdict(int)
+
+    @property
+    def url(self):
+        return 'http://localhost:%d' % self.server_port
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        server = self.server
+        if url.path == '/certs':
+            server.hits['certs'] += 1
+            self._reply(200, {'keys': server.jwks},
+                        {'Cache-Control': 'public, max-age=600'})
+            return
+        params = urlparse.parse_qs(url.query)
+        token = (params.get('id_token') or params.get('access_token'))[0]
+        server.hits[token] += 1
+        if token in server.tokens:
+            self._reply(200, {'user_id': 'user-%s' % token,
+                              'expires_in': server.tokens[token]})
+        else:
+            self._reply(400, {'error': 'invalid_token'})
+
+    def _reply(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in dict(headers).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(body))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGoogleTestCase(unittest.TestCase):
+    """Runs each test on fresh stubs, with settings pointing at a
+    FakeGoogle server."""
+
+    def setUp(self):
+        self.tb = sdk.startTestbed()
+        self.server = FakeGoogle()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.saved = dict((name, getattr(settings, name)) for name in
+            ('TOKENINFO_URL', 'GOOGLE_CERTS_URL', 'VERIFY_ID_TOKENS_LOCALLY'))
+        settings.TOKENINFO_URL = self.server.url + '/tokeninfo'
+        settings.GOOGLE_CERTS_URL = self.server.url + '/certs'
+        settings.VERIFY_ID_TOKENS_LOCALLY = False
+        utils._verifiedTokens = utils.cache.LRUCache(1000)
+        # record the TTLs the verified tokens are cached with
+        self.memcacheTtls = {}
+        self.memcacheSet = memcache.set
+        def recordingSet(key, value, time=0, **kwargs):
+            self.memcacheTtls[key] = time
+            return self.memcacheSet(key, value, time=time, **kwargs)
+        memcache.set = recordingSet
+
+    def tearDown(self):
+        memcache.set = self.memcacheSet
+        for name, value in self.saved.items():
+            setattr(settings, name, value)
+        self.server.shutdown()
+        self.server.server_close()
+        self.tb.deactivate()
+
+    def cacheKey(self, token):
+        return utils.MEMCACHE_TOKENINFO_KEY % hashlib.sha256(token).hexdigest()
+
+
+class TokeninfoTest(FakeGoogleTestCase):
+
+    def testRepeatRequestsAreServedFromCache(self):
+        self.server.tokens['good'] = 3600
+        os.environ['HTTP_AUTHORIZATION'] = 'Bearer good'
+        self.assertEqual('user-good', utils.getUserId(None, id_type='oauth'))
+        self.assertEqual('user-good', utils.getUserId(None, id_type='oauth'))
+        self.assertEqual(1, self.server.hits['good'])
+
+    def testMemcacheServesOtherInstances(self):
+        self.server.tokens['good'] = 3600
+        utils._getVerifiedTokenInfo('good')
+        # a fresh process-local cache, as on another instance
+        utils._verifiedTokens = utils.cache.LRUCache(1000)
+        self.assertEqual('user-good',
+                         utils._getVerifiedTokenInfo('good')['user_id'])
+        self.assertEqual(1, self.server.hits['good'])
+
+    def testCacheTtlIsCappedByTokenExpiry(self):
+        self.server.tokens['short'] = 30
+        self.server.tokens['long'] = settings.TOKEN_CACHE_MAX_TTL * 2
+        now = time.time()
+        utils._getVerifiedTokenInfo('short')
+        utils._getVerifiedTokenInfo('long')
+        self.assertTrue(0 < self.memcacheTtls[self.cacheKey('short')] <= 30)
+        self.assertEqual(settings.TOKEN_CACHE_MAX_TTL,
+                         self.memcacheTtls[self.cacheKey('long')])
+        value, expires = utils._verifiedTokens._entries[self.cacheKey('short')]
+        self.assertTrue(expires <= now + 31)
+
+    def testExpiredTokenIsNotCached(self):
+        self.server.tokens['expired'] = 0
+        utils._getVerifiedTokenInfo('expired')
+        utils._getVerifiedTokenInfo('expired')
+        self.assertNotIn(self.cacheKey('expired'), self.memcacheTtls)
+        self.assertEqual(2, self.server.hits['expired'])
+
+    def testFailuresAreNotCached(self):
+        self.assertEqual('', utils._getVerifiedTokenInfo('bad')['user_id'])
+        hits = self.server.hits['bad']
+        self.assertTrue(hits > 0)
+        self.assertEqual('', utils._getVerifiedTokenInfo('bad')['user_id'])
+        self.assertEqual(2 * hits, self.server.hits['bad'])
+        self.assertNotIn(self.cacheKey('bad'), self.memcacheTtls)
+        self.assertIsNone(memcache.get(self.cacheKey('bad')))
+
+
+@unittest.skipIf(utils.RSA is None, 'pycrypto is not installed')
+class IdTokenTest(FakeGoogleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = utils.RSA.generate(1024)
+
+    def setUp(self):
+        super(IdTokenTest, self).setUp()
+        settings.VERIFY_ID_TOKENS_LOCALLY = True
+        self.server.jwks = [{'kid': 'key1', 'kty': 'RSA', 'alg': 'RS256',
+                             'n': self.b64(self.bytes(self.key.n)),
+                             'e': self.b64(self.bytes(self.key.e))}]
+
+    @staticmethod
+    def bytes(number):
+        digits = '%x' % number
+        return ('0' * (len(digits) % 2) + digits).decode('hex')
+
+    @staticmethod
+    def b64(data):
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def makeToken(self, alg='RS256', kid='key1', **claims):
+        payload = {'iss': 'https://accounts.google.com',
+                   'aud': settings.WEB_CLIENT_ID, 'sub': '1234',
+                   'exp': int(time.time()) + 600}
+        payload.update(claims)
+        signed = '%s.%s' % (self.b64(json.dumps({'alg': alg, 'kid': kid})),
+                            self.b64(json.dumps(payload)))
+        signature = utils.PKCS1_v1_5.new(self.key).sign(
+            utils.SHA256.new(signed))
+        return '%s.%s' % (signed, self.b64(signature))
+
+    def testValidTokenIsVerifiedLocally(self):
+        token = self.makeToken()
+        info = utils._getVerifiedTokenInfo(token)
+        self.assertEqual('1234', info['user_id'])
+        self.assertEqual(0, self.server.hits[token])
+        # the certs are cached too
+        utils._getVerifiedTokenInfo(self.makeToken(sub='5678'))
+        self.assertEqual(1, self.server.hits['certs'])
+
+    def testBadAudienceIsRejected(self):
+        self.assertIsNone(utils._verifyIdToken(self.makeToken(aud='someone-else')))
+
+    def testBadIssuerIsRejected(self):
+        self.assertIsNone(utils._verifyIdToken(
+            self.makeToken(iss='https://evil.example.com')))
+
+    def testExpiredTokenIsRejected(self):
+        self.assertIsNone(utils._verifyIdToken(
+            self.makeToken(exp=int(time.time()) - 10)))
+
+    def testNonRs256TokenIsRejected(self):
+        self.assertIsNone(utils._verifyIdToken(self.makeToken(alg='HS256')))
+        self.assertIsNone(utils._verifyIdToken(self.makeToken(alg='none')))
+
+    def testBadSignatureIsRejected(self):
+        header, payload, signature = self.makeToken().split('.')
+        forged = self.b64(json.dumps({'iss': 'https://accounts.google.com',
+            'aud': settings.WEB_CLIENT_ID, 'sub': 'admin',
+            'exp': int(time.time()) + 600}))
+        self.assertIsNone(utils._verifyIdToken(
+            '%s.%s.%s' % (header, forged, signature)))
+
+    def testRejectedTokenFallsBackToTokeninfo(self):
+        token = self.makeToken(aud='someone-else')
+        self.assertEqual('', utils._getVerifiedTokenInfo(token)['user_id'])
+        self.assertTrue(self.server.hits[token] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
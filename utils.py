@@ -1,10 +1,32 @@
+import base64
+import hashlib
 import json
 import os
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
+import cache
+import settings
+
+# pycrypto is only needed for local ID token verification
+try:
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+except ImportError:
+    RSA = None
+
+MEMCACHE_TOKENINFO_KEY = "TOKENINFO:%s"
+MEMCACHE_CERTS_KEY = "GOOGLE_CERTS"
+DEFAULT_CERTS_TTL = 3600
+ID_TOKEN_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# hashed token -> verified token info; entries expire with the token
+_verifiedTokens = cache.LRUCache(1000)
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -14,25 +36,7 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getVerifiedTokenInfo(token).get('user_id', '')
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
@@ -43,3 +47,109 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def _getVerifiedTokenInfo(token):
+    """Return the verified info of a bearer token, from the process-local
+    cache, memcache, a local ID token check or tokeninfo, in that order.
+    Cache entries never outlive the token itself."""
+    key = MEMCACHE_TOKENINFO_KEY % hashlib.sha256(token).hexdigest()
+    info = _verifiedTokens.get(key)
+    if info is not None:
+        return info
+    info = memcache.get(key)
+    if info is None:
+        if settings.VERIFY_ID_TOKENS_LOCALLY and 'OAUTH_USER_ID' not in os.environ:
+            info = _verifyIdToken(token)
+        if info is None:
+            info = _fetchTokenInfo(token)
+        if not info.get('user_id'):
+            # don't cache failed verifications
+            return info
+        ttl = int(min(info['expires_at'] - time.time(),
+                      settings.TOKEN_CACHE_MAX_TTL))
+        if ttl > 0:
+            memcache.set(key, info, time=ttl)
+    ttl = int(min(info['expires_at'] - time.time(),
+                  settings.TOKEN_CACHE_MAX_TTL))
+    if ttl > 0:
+        _verifiedTokens.set(key, info, ttl=ttl)
+    return info
+
+
+def _fetchTokenInfo(token):
+    """Ask Google's tokeninfo endpoint who a token belongs to."""
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    url = ('%s?%s=%s' % (settings.TOKENINFO_URL, token_type, token))
+    user = {}
+    wait = 1
+    for i in range(3):
+        resp = urlfetch.fetch(url)
+        if resp.status_code == 200:
+            user = json.loads(resp.content)
+            break
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            url = ('%s?%s=%s' % (settings.TOKENINFO_URL, 'access_token', token))
+        else:
+            time.sleep(wait)
+            wait = wait + i
+    return {'user_id': user.get('user_id', ''),
+            'expires_at': time.time() + int(user.get('expires_in', 0))}
+
+
+def _b64decode(segment):
+    """Decode an unpadded base64url JWT segment."""
+    return base64.urlsafe_b64decode(str(segment) + '=' * (-len(segment) % 4))
+
+
+def _getGoogleCerts():
+    """Return Google's ID token signing keys as a dict of kid -> JWK,
+    cached for as long as Google says they are valid."""
+    certs = _verifiedTokens.get(MEMCACHE_CERTS_KEY)
+    if certs is not None:
+        return certs
+    ttl = DEFAULT_CERTS_TTL
+    certs = memcache.get(MEMCACHE_CERTS_KEY)
+    if certs is None:
+        resp = urlfetch.fetch(settings.GOOGLE_CERTS_URL)
+        if resp.status_code != 200:
+            return {}
+        certs = dict((jwk['kid'], jwk) for jwk in json.loads(resp.content)['keys'])
+        for directive in resp.headers.get('cache-control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'max-age' and value.isdigit():
+                ttl = int(value)
+        memcache.set(MEMCACHE_CERTS_KEY, certs, time=ttl)
+    _verifiedTokens.set(MEMCACHE_CERTS_KEY, certs, ttl=ttl)
+    return certs
+
+
+def _verifyIdToken(token):
+    """Check an ID token's RS256 signature and claims locally; return its
+    info, or None if it can't be verified here."""
+    if RSA is None or token.count('.') != 2:
+        return None
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64decode(header_b64))
+        payload = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except (TypeError, ValueError):
+        return None
+    jwk = _getGoogleCerts().get(header.get('kid'))
+    if header.get('alg') != 'RS256' or not jwk:
+        return None
+    public_key = RSA.construct((
+        long(_b64decode(jwk['n']).encode('hex'), 16),
+        long(_b64decode(jwk['e']).encode('hex'), 16)))
+    digest = SHA256.new('%s.%s' % (header_b64, payload_b64))
+    if not PKCS1_v1_5.new(public_key).verify(digest, signature):
+        return None
+    audiences = (settings.WEB_CLIENT_ID, settings.ANDROID_AUDIENCE)
+    if payload.get('iss') not in ID_TOKEN_ISSUERS or \
+            payload.get('aud') not in audiences or \
+            payload.get('exp', 0) <= time.time():
+        return None
+    return {'user_id': payload.get('sub', ''), 'expires_at': payload['exp']}